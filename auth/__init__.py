@@ -1,21 +1,31 @@
 ''' To initialize auth app'''
+import json
 import os
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flasgger import Swagger
-from auth.utils.logger import log_warning
-from .config import DevelopmentConfig, TestingConfig, Config
+from auth.utils.logger import log_warning, init_request_logging, deferred_log_sinks
+from auth.utils.hashing import PasswordHashingEngine
+from auth.utils.identity import token_cache
+from auth.utils.user_cache import user_cache
+from auth.utils.keyring import KeyRing
+from auth.utils.metrics import metrics, count_rate_limit_breach
+from auth.utils.query_profiler import query_profiler
+# Importing SQLStorage registers the sql+ rate limit storage schemes
+from auth.utils.rate_limit import SQLStorage # pylint: disable=unused-import
+from .config import DevelopmentConfig, TestingConfig, ProductionConfig, Config
 
 db = SQLAlchemy()
 migrate = Migrate()
-bcrypt = Bcrypt()
 jwt = JWTManager()
+hasher = PasswordHashingEngine()
+key_ring = KeyRing()
+limiter = Limiter(get_remote_address, on_breach=count_rate_limit_breach)
 
 swagger_config = {
     "headers": [],
@@ -47,7 +57,6 @@ swagger_template = {
             "url": "https://opensource.org/licenses/MIT"
         }
     },
-    "host": "", # Initially empty
     "basePath": "/",  # Base path for the APIs
     "schemes": [
         "http",
@@ -81,31 +90,67 @@ swagger_template = {
     ]
 }
 
+def init_swagger(app):
+    '''Register the API docs without building the spec.
+
+    flasgger builds the spec on the first request for it and caches it;
+    a spec prebuilt by `flask build-apispec` is seeded into that cache
+    instead so no worker has to walk the routes at all.
+    '''
+    if not app.config.get('SWAGGER_ENABLED', True):
+        return None
+    host = app.config.get('SWAGGER_HOST')
+    template = dict(swagger_template, host=host) if host else swagger_template
+    swagger = Swagger(app, config=swagger_config, template=template)
+    spec_file = app.config.get('SWAGGER_SPEC_FILE')
+    if spec_file and os.path.exists(spec_file):
+        with open(spec_file, encoding='utf-8') as spec_stream:
+            spec = json.load(spec_stream)
+        if host:
+            spec['host'] = host
+        swagger.apispecs['apispec_1'] = spec
+    return swagger
+
 def create_app():
     ''' Create app'''
+    # Records logged while booting wait on the log queue, so creating an
+    # app opens no log file and starts no threads
+    with deferred_log_sinks():
+        return _build_app()
+
+def _build_app():
+    ''' Configure the app and its extensions'''
     app = Flask(__name__)
 
     # Load Configuration
     config_map = {
         'development': DevelopmentConfig,
         'testing': TestingConfig,
-        # 'production': ProductionConfig
+        'production': ProductionConfig
     }
 
     env = os.getenv('FLASK_ENV', 'development')
     app.config.from_object(config_map.get(env, Config))
 
-    limiter = Limiter( # pylint: disable=unused-variable
-        get_remote_address,
-        app=app,
-        default_limits=["20 per 5 minutes"]
-    )
+    init_request_logging(app)
+    metrics.init_app(app)
+    query_profiler.init_app(app)
 
     # Initialize extensions
     db.init_app(app)
+    from .utils.database import init_engines # pylint: disable=import-outside-toplevel
+    init_engines(app)
     migrate.init_app(app, db)
-    bcrypt.init_app(app)
     jwt.init_app(app)
+    key_ring.init_app(app)
+    if key_ring.enabled:
+        jwt.additional_headers_loader(key_ring.signing_headers)
+        jwt.encode_key_loader(key_ring.encode_key)
+        jwt.decode_key_loader(key_ring.decode_key)
+    hasher.init_app(app)
+    token_cache.init_app(app)
+    user_cache.init_app(app)
+    limiter.init_app(app)
 
     # Initialize CORS
     allowed_origins = os.getenv('ALLOWED_ORIGINS')
@@ -119,38 +164,94 @@ def create_app():
         allowed_origins = allowed_origins.split(',')
     CORS(app, origins=allowed_origins, supports_credentials=True)
 
+    from .services.revocation import revocation_list # pylint: disable=import-outside-toplevel
+    revocation_list.init_app(app)
+    from .services.auth_service import introspection_cache # pylint: disable=import-outside-toplevel
+    introspection_cache.init_app(app, 'INTROSPECTION_CACHE')
+
+    @jwt.token_in_blocklist_loader
+    def check_if_token_revoked(jwt_header, jwt_payload): # pylint: disable=unused-argument
+        return revocation_list.is_revoked(jwt_payload)
+
     from .routes.auth import auth_bp # pylint: disable=import-outside-toplevel
+    from .routes.well_known import well_known_bp # pylint: disable=import-outside-toplevel
+    from .routes.metrics import metrics_bp # pylint: disable=import-outside-toplevel
     from .errors.handlers import error # pylint: disable=import-outside-toplevel
 
     app.register_blueprint(error)
     app.register_blueprint(auth_bp, url_prefix='/api/v1/auth')
+    app.register_blueprint(well_known_bp, url_prefix='/.well-known')
+    app.register_blueprint(metrics_bp)
 
-    # Update Swagger host dynamically
-    with app.test_request_context():
-        from auth.utils.logger import log_debug # pylint: disable=import-outside-toplevel
-
-        swagger_template["host"] = os.getenv('SWAGGER_HOST', request.host)
-        Swagger(app, config=swagger_config, template=swagger_template)
-        log_debug(
-            "createapp.update_swagger_host()", f"Swagger host updated- {swagger_template['host']}")
+    init_swagger(app)
 
-    # create db tables from models if not exists
-    with app.app_context():
-        try:
-            db.create_all()
-        except Exception as e: # pylint: disable=broad-exception-caught
-            from auth.utils.logger import log_error # pylint: disable=import-outside-toplevel
-            log_error("create_app()", f"An error occurred: {e}")
+    # Periodically delete expired refresh tokens in this process
+    if app.config.get('TOKEN_SWEEP_INTERVAL'):
+        from .services.token_sweeper import TokenSweeper # pylint: disable=import-outside-toplevel
+        sweeper = TokenSweeper(
+            app, app.config['TOKEN_SWEEP_INTERVAL'], app.config['TOKEN_SWEEP_BATCH_SIZE'])
+        sweeper.start()
+        app.extensions['token_sweeper'] = sweeper
 
     # General route to get logs
     @app.route('/logs', methods=['GET'])
     def get_logs():
-        """Endpoint to retrieve logs"""
-        log_file_path = 'logs/app.log'
+        """Endpoint to retrieve logs
+
+        Query parameters:
+            tail     - last N lines across the rotated files (default 100)
+            offset   - byte offset to page forward from instead of tailing;
+                       the next offset is returned in X-Log-Next-Offset
+            limit    - page size when paging with offset
+            file     - rotated file to page through (0 = app.log, 1 = app.log.1, ...)
+            follow   - stream new lines as server-sent events
+            level, function, user_id, since, until - filters
+        """
+        # pylint: disable=import-outside-toplevel
+        from auth.utils import log_reader
+        from auth.utils.logger import LOG_FILE_PATH, LOG_BACKUP_COUNT
+        args = request.args
+        max_lines = app.config['LOGS_MAX_LINES']
         try:
-            with open(log_file_path, 'r', encoding='utf-8') as file:
-                log_content = file.read()
-            return Response(log_content, mimetype='text/plain')
+            log_filter = log_reader.LogFilter(
+                level=args.get('level'),
+                function=args.get('function'),
+                user_id=args.get('user_id'),
+                since=args.get('since'),
+                until=args.get('until'),
+            )
+            files = log_reader.log_files(LOG_FILE_PATH, LOG_BACKUP_COUNT)
+            if args.get('follow', '').lower() in ('1', 'true', 'yes'):
+                offset = args.get('offset', type=int)
+                if offset is None:
+                    offset = os.path.getsize(LOG_FILE_PATH) if files else 0
+                events = log_reader.follow(
+                    LOG_FILE_PATH, offset, log_filter, app.config['LOGS_FOLLOW_MAX_SECONDS'])
+                return Response(
+                    stream_with_context(events),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            if 'offset' in args:
+                index = args.get('file', 0, type=int)
+                if not 0 <= index <= LOG_BACKUP_COUNT:
+                    return jsonify({"error": "Invalid file index"}), 400
+                path = log_reader.rotated_path(LOG_FILE_PATH, index)
+                limit = min(args.get('limit', 100, type=int), max_lines)
+                if limit < 1:
+                    return jsonify({"error": "limit must be at least 1"}), 400
+                lines, next_offset = log_reader.read_page(
+                    path, args.get('offset', 0, type=int), limit, log_filter)
+                return Response(
+                    ''.join(f"{line}\n" for line in lines),
+                    mimetype='text/plain',
+                    headers={'X-Log-Next-Offset': str(next_offset)})
+            count = min(args.get('tail', 100, type=int), max_lines)
+            if count < 1:
+                return jsonify({"error": "tail must be at least 1"}), 400
+            lines = log_reader.tail(files, count, log_filter)
+            return Response(''.join(f"{line}\n" for line in lines), mimetype='text/plain')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         except Exception as e:  # pylint: disable=broad-exception-caught
             return jsonify({"error": str(e)}), 500
 
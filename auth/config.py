@@ -4,13 +4,192 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _env_flag(name, default):
+    '''Read a boolean environment variable'''
+    return os.getenv(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options_from_env(database_url):
+    '''Build SQLALCHEMY_ENGINE_OPTIONS for database_url from DB_* variables.
+
+    Pool sizes apply per process, so size them per gunicorn worker:
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below the
+    server's connection limit.
+    '''
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+    options = {
+        'pool_pre_ping': _env_flag('DB_POOL_PRE_PING', True),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    }
+    if database_url.startswith('sqlite'):
+        # sqlite3's timeout is how long to wait on a locked database
+        options['connect_args'] = {'timeout': statement_timeout / 1000}
+        return options
+
+    options.update({
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '5')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+    })
+    if database_url.startswith('postgres'):
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    elif database_url.startswith('mysql'):
+        options['connect_args'] = {
+            'init_command': f'SET SESSION max_execution_time={statement_timeout}'}
+    return options
+
+
 class Config: # pylint: disable=too-few-public-methods
     ''' Base Configuration for all environments '''
     SECRET_KEY = os.getenv('SECRET_KEY', 'default_secret_key')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///site.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Request bodies: MAX_CONTENT_LENGTH caps every request (including
+    # bodies sent without a Content-Length) and BODY_LIMIT_<ROUTE> is a
+    # tighter per-route ceiling checked against Content-Length before
+    # anything reads the body. Passwords longer than PASSWORD_MAX_BYTES
+    # (UTF-8) are rejected without being hashed.
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', str(128 * 1024)))
+    BODY_LIMIT_REGISTER = int(os.getenv('BODY_LIMIT_REGISTER', '1024'))
+    BODY_LIMIT_LOGIN = int(os.getenv('BODY_LIMIT_LOGIN', '1024'))
+    BODY_LIMIT_PASSWORD = int(os.getenv('BODY_LIMIT_PASSWORD', '1024'))
+    BODY_LIMIT_INTROSPECT = int(os.getenv('BODY_LIMIT_INTROSPECT', str(128 * 1024)))
+    PASSWORD_MAX_BYTES = int(os.getenv('PASSWORD_MAX_BYTES', '128'))
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'default_jwt_secret_key')
 
+    # Token signing: HS256 signs with JWT_SECRET_KEY. RS256/RS384/RS512 or
+    # EdDSA sign with a rotating key ring in JWT_KEY_DIR (shared by all
+    # workers) whose public keys are served at /.well-known/jwks.json.
+    # A new key is generated every JWT_KEY_ROTATION_INTERVAL seconds (0 =
+    # never), published JWT_KEY_PUBLISH_AHEAD seconds before it signs
+    # anything (keep it above JWKS_MAX_AGE) and kept JWT_KEY_RETENTION
+    # seconds after it stops signing (keep it above the refresh token
+    # lifetime). Set JWT_KEY_AUTO_ROTATE=false to rotate only with
+    # `flask rotate-keys`.
+    JWT_ALGORITHM = os.getenv('JWT_ALGORITHM', 'HS256')
+    JWT_KEY_DIR = os.getenv('JWT_KEY_DIR', 'instance/jwt_keys')
+    JWT_KEY_ROTATION_INTERVAL = int(os.getenv('JWT_KEY_ROTATION_INTERVAL', str(30 * 24 * 3600)))
+    JWT_KEY_PUBLISH_AHEAD = int(os.getenv('JWT_KEY_PUBLISH_AHEAD', '3600'))
+    JWT_KEY_RETENTION = int(os.getenv('JWT_KEY_RETENTION', '7200'))
+    JWT_KEY_RELOAD_INTERVAL = int(os.getenv('JWT_KEY_RELOAD_INTERVAL', '60'))
+    JWT_KEY_AUTO_ROTATE = _env_flag('JWT_KEY_AUTO_ROTATE', True)
+    JWT_RSA_KEY_SIZE = int(os.getenv('JWT_RSA_KEY_SIZE', '2048'))
+    JWKS_MAX_AGE = int(os.getenv('JWKS_MAX_AGE', '300'))
+
+    # Password hashing: algorithm for new hashes (scrypt, bcrypt, argon2 or
+    # werkzeug) and its cost. Hashes made with another algorithm or an
+    # outdated cost are upgraded on the next successful login.
+    PASSWORD_HASH_ALGORITHM = os.getenv('PASSWORD_HASH_ALGORITHM', 'scrypt')
+    PASSWORD_SALT_LENGTH = int(os.getenv('PASSWORD_SALT_LENGTH', '16'))
+    PASSWORD_SCRYPT_LOG_N = int(os.getenv('PASSWORD_SCRYPT_LOG_N', '15'))
+    PASSWORD_SCRYPT_R = int(os.getenv('PASSWORD_SCRYPT_R', '8'))
+    PASSWORD_SCRYPT_P = int(os.getenv('PASSWORD_SCRYPT_P', '1'))
+    PASSWORD_BCRYPT_ROUNDS = int(os.getenv('PASSWORD_BCRYPT_ROUNDS', '12'))
+    PASSWORD_ARGON2_TIME_COST = int(os.getenv('PASSWORD_ARGON2_TIME_COST', '3'))
+    PASSWORD_ARGON2_MEMORY_COST = int(os.getenv('PASSWORD_ARGON2_MEMORY_COST', '65536'))
+    PASSWORD_ARGON2_PARALLELISM = int(os.getenv('PASSWORD_ARGON2_PARALLELISM', '4'))
+    # werkzeug method string (e.g. pbkdf2:sha256:600000), used by the werkzeug hasher
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    # Worker pool backend (process, thread or inline) and its backpressure limits.
+    # Every gunicorn worker gets its own pool of PASSWORD_HASH_WORKERS, so keep
+    # gunicorn workers * PASSWORD_HASH_WORKERS near the CPU count; 0 means one
+    # per CPU, for a single process such as a bulk import
+    PASSWORD_HASH_BACKEND = os.getenv('PASSWORD_HASH_BACKEND', 'process')
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', '32'))
+    PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '10'))
+    PASSWORD_HASH_RETRY_AFTER = int(os.getenv('PASSWORD_HASH_RETRY_AFTER', '1'))
+
+    # Expired refresh token sweeper: rows per delete batch, and the interval
+    # in seconds of the in-process scheduler (0 disables it; use the
+    # `flask sweep-tokens` command from cron instead)
+    TOKEN_SWEEP_BATCH_SIZE = int(os.getenv('TOKEN_SWEEP_BATCH_SIZE', '1000'))
+    TOKEN_SWEEP_INTERVAL = int(os.getenv('TOKEN_SWEEP_INTERVAL', '0'))
+
+    # Rate limiting. Storage is per process with memory://; use redis://
+    # (any Redis-compatible server) or sql+<database url> to share limits
+    # between workers. Routes with their own RATELIMIT_<ROUTE> limit do
+    # not also count against RATELIMIT_DEFAULT.
+    RATELIMIT_STORAGE_URI = os.getenv('RATELIMIT_STORAGE_URI', 'memory://')
+    RATELIMIT_STRATEGY = os.getenv('RATELIMIT_STRATEGY', 'moving-window')
+    RATELIMIT_DEFAULT = os.getenv('RATELIMIT_DEFAULT', '20 per 5 minutes')
+    RATELIMIT_HEADERS_ENABLED = True
+    # Keyed by email + IP, plus a wider per-IP ceiling
+    RATELIMIT_LOGIN = os.getenv('RATELIMIT_LOGIN', '5 per minute')
+    RATELIMIT_LOGIN_IP = os.getenv('RATELIMIT_LOGIN_IP', '30 per minute')
+    RATELIMIT_REGISTER = os.getenv('RATELIMIT_REGISTER', '10 per hour')
+    RATELIMIT_REFRESH = os.getenv('RATELIMIT_REFRESH', '60 per 5 minutes')
+    RATELIMIT_PASSWORD = os.getenv('RATELIMIT_PASSWORD', '5 per 15 minutes')
+    RATELIMIT_INTROSPECT = os.getenv('RATELIMIT_INTROSPECT', '600 per minute')
+
+    # Cache of verified access tokens (skips signature checks for reused
+    # tokens). Entries expire at the token's exp or after TOKEN_CACHE_MAX_TTL
+    # seconds, which bounds how long a revocation made in another worker
+    # can go unnoticed.
+    TOKEN_CACHE_ENABLED = _env_flag('TOKEN_CACHE_ENABLED', False)
+    TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '10000'))
+    TOKEN_CACHE_MAX_TTL = int(os.getenv('TOKEN_CACHE_MAX_TTL', '60'))
+
+    # Token revocation: how often each process pulls new revocations (s),
+    # how often it rebuilds its bloom filter from scratch (s), how long a
+    # per-user cutoff matters (the longest token lifetime, s), and the
+    # bloom filter / confirmation cache sizing
+    REVOCATION_SYNC_INTERVAL = int(os.getenv('REVOCATION_SYNC_INTERVAL', '5'))
+    REVOCATION_REBUILD_INTERVAL = int(os.getenv('REVOCATION_REBUILD_INTERVAL', '3600'))
+    REVOCATION_CUTOFF_RETENTION = int(os.getenv('REVOCATION_CUTOFF_RETENTION', '3600'))
+    REVOCATION_BLOOM_CAPACITY = int(os.getenv('REVOCATION_BLOOM_CAPACITY', '100000'))
+    REVOCATION_BLOOM_ERROR_RATE = float(os.getenv('REVOCATION_BLOOM_ERROR_RATE', '0.001'))
+    REVOCATION_CACHE_SIZE = int(os.getenv('REVOCATION_CACHE_SIZE', '1024'))
+
+    # Token introspection: HTTP Basic client credentials as "id:secret,..."
+    # (without any, every call is refused unless INTROSPECTION_ALLOW_ANONYMOUS
+    # opens the endpoint to anyone), the largest batch, and a cache of
+    # results. A cached "active" can outlive a revocation made by another
+    # worker by up to INTROSPECTION_CACHE_TTL seconds (0 disables it).
+    INTROSPECTION_CLIENTS = dict(
+        client.split(':', 1) for client in os.getenv('INTROSPECTION_CLIENTS', '').split(',')
+        if ':' in client)
+    INTROSPECTION_ALLOW_ANONYMOUS = _env_flag('INTROSPECTION_ALLOW_ANONYMOUS', False)
+    INTROSPECTION_MAX_TOKENS = int(os.getenv('INTROSPECTION_MAX_TOKENS', '100'))
+    INTROSPECTION_CACHE_SIZE = int(os.getenv('INTROSPECTION_CACHE_SIZE', '10000'))
+    INTROSPECTION_CACHE_TTL = int(os.getenv('INTROSPECTION_CACHE_TTL', '5'))
+
+    # Per-process cache of users and their password hashes for logins and
+    # password changes, off unless USER_CACHE_TTL is set. Other workers may
+    # accept a changed password for up to USER_CACHE_TTL seconds.
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '0'))
+
+    # API docs: SWAGGER_ENABLED=false skips flasgger entirely. The spec is
+    # built on the first /apispec_1.json request, or loaded from
+    # SWAGGER_SPEC_FILE when `flask build-apispec` wrote one at build time.
+    # Without SWAGGER_HOST the docs target whichever host served them.
+    SWAGGER_ENABLED = _env_flag('SWAGGER_ENABLED', True)
+    SWAGGER_HOST = os.getenv('SWAGGER_HOST') or None
+    SWAGGER_SPEC_FILE = os.getenv('SWAGGER_SPEC_FILE') or None
+
+    # /metrics: with several gunicorn workers set METRICS_DIR to a directory
+    # they share (emptied before the master starts); each worker writes its
+    # samples there at most every METRICS_FLUSH_INTERVAL seconds
+    METRICS_ENABLED = _env_flag('METRICS_ENABLED', True)
+    METRICS_DIR = os.getenv('METRICS_DIR') or None
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+    # SQL profiling: record every statement of a request with its timing
+    # and call site, and flag statements repeated REPEAT_THRESHOLD times.
+    # SQL_PROFILER_ENABLED profiles every request; otherwise only requests
+    # sending the SQL_PROFILER_HEADER header (never in production).
+    SQL_PROFILER_ENABLED = _env_flag('SQL_PROFILER_ENABLED', False)
+    SQL_PROFILER_HEADER = os.getenv('SQL_PROFILER_HEADER', 'X-Profile-SQL') or None
+    SQL_PROFILER_REPEAT_THRESHOLD = int(os.getenv('SQL_PROFILER_REPEAT_THRESHOLD', '2'))
+
+    # /logs: largest window a single request may ask for, and how long a
+    # ?follow=true event stream stays open
+    LOGS_MAX_LINES = int(os.getenv('LOGS_MAX_LINES', '1000'))
+    LOGS_FOLLOW_MAX_SECONDS = int(os.getenv('LOGS_FOLLOW_MAX_SECONDS', '300'))
+
 class DevelopmentConfig(Config): # pylint: disable=too-few-public-methods
     ''' Base Configuration for Development environment '''
     DEBUG = True
@@ -19,7 +198,23 @@ class TestingConfig(Config):# pylint: disable=too-few-public-methods
     ''' Base Configuration for Testing environment '''
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///test.db'
+    PASSWORD_HASH_BACKEND = 'inline'
+    RATELIMIT_ENABLED = False
 
-# class ProductionConfig(Config):
-#     ''' Base Configuration for Production environment '''
-#     pass
+class ProductionConfig(Config):# pylint: disable=too-few-public-methods
+    ''' Base Configuration for Production environment '''
+    DEBUG = False
+    SQL_PROFILER_HEADER = None
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options_from_env(Config.SQLALCHEMY_DATABASE_URI)
+    # Applied on every new SQLite connection; ignored for other databases
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    # Optional read replica for lag-tolerant reads such as the user export
+    # (see utils.database.read_engine); logins always use the primary
+    if os.getenv('DATABASE_REPLICA_URL'):
+        SQLALCHEMY_BINDS = {
+            'replica': {
+                'url': os.getenv('DATABASE_REPLICA_URL'),
+                **engine_options_from_env(os.getenv('DATABASE_REPLICA_URL')),
+            }
+        }
@@ -2,6 +2,7 @@
 from flask import Blueprint, jsonify
 from pydantic import ValidationError
 from auth.utils.logger import log_route
+from auth.utils.hashing import HasherBusyError
 
 error = Blueprint("error", __name__)
 
@@ -44,6 +45,16 @@ def raise_validation_error(error):
         400,
     )
 
+@error.app_errorhandler(HasherBusyError)
+@log_route
+def hasher_busy(error):
+    """app error handler for an overloaded password hashing engine"""
+    return (
+        {"error": "Service Unavailable", "message": "Server is busy, please retry shortly"},
+        503,
+        {"Retry-After": str(error.retry_after)},
+    )
+
 @error.app_errorhandler(400)
 @log_route
 def bad_request(error):
@@ -131,6 +142,13 @@ def cant_process(error):
     return {"error": error.name, "message": error.description}, 422
 
 
+@error.app_errorhandler(413)
+@log_route
+def payload_too_large(error):
+    """app error handler for request bodies over MAX_CONTENT_LENGTH or a route's BODY_LIMIT"""
+    return {"error": error.name, "message": error.description}, 413
+
+
 # pylint: disable=function-redefined
 @error.app_errorhandler(429)
 @log_route
@@ -4,6 +4,8 @@ Base template for the Event driven application
 """
 from uuid import uuid4
 from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 from auth import db
 
 
@@ -35,20 +37,20 @@ class BaseModel(db.Model):
         self.created_at = datetime.now()
         self.updated_at = datetime.now()
 
+    # insert/update/delete only stage the change in the session; the
+    # caller commits, normally through services.unit_of_work.unit_of_work()
+
     def insert(self):
-        """Insert the current object into the database"""
+        """Add the current object to the session"""
         db.session.add(self)
-        db.session.commit()
 
     def update(self):
-        """Update the current object in the database"""
+        """Mark the current object as updated"""
         self.updated_at = datetime.now()
-        db.session.commit()
 
     def delete(self):
-        """Delete the current object from the database"""
+        """Delete the current object from the session"""
         db.session.delete(self)
-        db.session.commit()
 
     def format(self):
         """Format the object's attributes as a dictionary"""
@@ -56,3 +58,36 @@ class BaseModel(db.Model):
         raise NotImplementedError(
             "Subclasses must implement the 'format' method"
         )
+
+    @classmethod
+    def on_change(cls, row_id):
+        """Called when a row is updated or deleted: when the change is
+        flushed, and again once it is committed. Models whose rows are
+        cached override this to drop the cached copy."""
+
+
+_CHANGED_KEY = 'changed_rows'
+
+
+@event.listens_for(BaseModel, 'after_update', propagate=True)
+@event.listens_for(BaseModel, 'after_delete', propagate=True)
+def _row_changed(mapper, connection, target):  # pylint: disable=unused-argument
+    """Run on_change at flush and queue it to run again after the commit"""
+    type(target).on_change(target.id)
+    session = object_session(target)
+    if session is not None:
+        # A concurrent reader may cache the old row before we commit
+        session.info.setdefault(_CHANGED_KEY, set()).add((type(target), target.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _rows_committed(session):
+    """Run on_change for the rows the committed transaction changed"""
+    for model, row_id in session.info.pop(_CHANGED_KEY, ()):
+        model.on_change(row_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rows_rolled_back(session):
+    """Rolled back changes need no second invalidation"""
+    session.info.pop(_CHANGED_KEY, None)
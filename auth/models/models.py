@@ -1,6 +1,8 @@
 '''Database Model structured'''
-from werkzeug.security import generate_password_hash, check_password_hash
-from auth import db
+from sqlalchemy.orm import validates
+from auth import db, hasher
+from auth.utils.user_cache import user_cache
+from auth.utils.validation import normalize_email
 from .base import BaseModel
 
 class User(BaseModel):
@@ -9,17 +11,35 @@ class User(BaseModel):
 
     username = db.Column(db.String(20), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(60), nullable=False)
+    # Lower-cased email, kept in step with email; every lookup by email uses it
+    email_normalized = db.Column(db.String(120), unique=True, index=True, nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     refresh_tokens = db.relationship('RefreshToken', backref='user', lazy=True)
 
+    @validates('email')
+    def _normalize_email(self, key, email):  # pylint: disable=unused-argument
+        '''Keep email_normalized in step with email'''
+        self.email_normalized = normalize_email(email)
+        return email
+
+    @classmethod
+    def on_change(cls, row_id):
+        '''Drop the cached copy of the user'''
+        user_cache.invalidate(row_id)
+
     def set_password(self, password):
         '''Set password for the user'''
-        self.password_hash = generate_password_hash(password)
-        db.session.commit()
+        self.password_hash = hasher.hash(password)
+        # Stop serving the old hash now rather than at the next flush
+        user_cache.invalidate(self.id)
 
     def check_password(self, password):
         '''Check if the provided password matches the stored password'''
-        return check_password_hash(self.password_hash, password)
+        return hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        '''Check if the stored hash uses an outdated algorithm or cost'''
+        return hasher.needs_rehash(self.password_hash)
 
     def __repr__(self):
         '''Return a string representation of the user object'''
@@ -35,23 +55,70 @@ class User(BaseModel):
         }
 
 class RefreshToken(BaseModel):
-    '''Refresh Token Table'''
+    '''Refresh Token Table
+
+    Rows are keyed on the token's jti claim rather than the encoded JWT.
+    Every token issued by rotating a refresh token shares the family_id
+    of the login that started the chain, so reuse of an already rotated
+    token can revoke the whole family.
+    '''
     __tablename__ = 'refreshtokens'
 
-    token = db.Column(db.String(256), unique=True, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    jti = db.Column(db.String(32), unique=True, nullable=False)
+    family_id = db.Column(db.String(32), index=True, nullable=False)
+    user_id = db.Column(db.String(255), db.ForeignKey('users.id'), nullable=False)
     used = db.Column(db.Boolean, default=False, nullable=False)
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, index=True, nullable=False)
 
     def __repr__(self):
         '''Return a string representation of the refresh token object'''
-        return f"RefreshToken('{self.token}', '{self.user_id}', '{self.expires_at}')"
+        return f"RefreshToken('{self.jti}', '{self.user_id}', '{self.expires_at}')"
 
     def format(self):
         '''Return a dictionary representation of the refresh token object'''
         return {
-            'token': self.token,
+            'jti': self.jti,
+            'family_id': self.family_id,
             'user_id': self.user_id,
             'used': self.used,
             'expires_at': self.expires_at
         }
+
+class RevokedToken(BaseModel):
+    '''Revoked Token Table: tokens revoked before their expiry, by jti'''
+    __tablename__ = 'revokedtokens'
+
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    user_id = db.Column(db.String(255), db.ForeignKey('users.id'), nullable=False)
+    expires_at = db.Column(db.DateTime, index=True, nullable=False)
+
+    def __repr__(self):
+        '''Return a string representation of the revoked token object'''
+        return f"RevokedToken('{self.jti}', '{self.user_id}', '{self.expires_at}')"
+
+    def format(self):
+        '''Return a dictionary representation of the revoked token object'''
+        return {
+            'jti': self.jti,
+            'user_id': self.user_id,
+            'expires_at': self.expires_at
+        }
+
+class TokenCutoff(BaseModel):
+    '''Token Cutoff Table: every token of the user issued before not_before is revoked'''
+    __tablename__ = 'tokencutoffs'
+
+    user_id = db.Column(db.String(255), db.ForeignKey('users.id'), unique=True, nullable=False)
+    # Unix timestamp (with fractions) compared against the tokens' iat claim
+    not_before = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        '''Return a string representation of the token cutoff object'''
+        return f"TokenCutoff('{self.user_id}', '{self.not_before}')"
+
+    def format(self):
+        '''Return a dictionary representation of the token cutoff object'''
+        return {
+            'user_id': self.user_id,
+            'not_before': self.not_before
+        }
@@ -1,8 +1,15 @@
 '''Contains the route and its business logic call to authservice'''
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
+import hmac
+from flask import Blueprint, current_app, request
 from flasgger import swag_from
+from auth import limiter
+from auth.utils.identity import auth_required, current_claims, current_identity
 from auth.utils.logger import log_route
+from auth.utils.payload import body_limit
+from auth.utils.rate_limit import route_limit, email_and_ip, identity_or_ip
+from ..schemas.auth import (
+    ChangePasswordRequest, LoginRequest, RegisterRequest, ResetPasswordRequest
+)
 from ..services.auth_service import AuthService
 
 auth_bp = Blueprint('auth', __name__)
@@ -25,6 +32,8 @@ def test():
 
 
 @auth_bp.route('/register', methods=['POST'])
+@body_limit('REGISTER')
+@limiter.limit(route_limit('REGISTER'))
 @log_route
 def register():
     """
@@ -56,24 +65,26 @@ def register():
           application/json:
             message: User registered successfully
       400:
-        description: Missing required fields or validation errors
+        description: >
+          Missing or invalid fields, listed per field as below. A taken
+          username or email returns only a message, e.g.
+          {"message": "Username already exists"}.
         examples:
           application/json:
-            message: Email already exists
+            error: Bad Request
+            message:
+              - field: email
+                error: Invalid email address
     """
-    data = request.get_json()
+    body = RegisterRequest.from_request()
 
-    if not data or not data.get('username') or not data.get('email') or not data.get('password'):
-        return {'message': 'Missing required fields'}, 400
-
-    username = data['username']
-    email = data['email']
-    password = data['password']
-
-    response, status = AuthService.register_user(username, email, password)
+    response, status = AuthService.register_user(body.username, body.email, body.password)
     return response, status
 
 @auth_bp.route('/login', methods=['POST'])
+@body_limit('LOGIN')
+@limiter.limit(route_limit('LOGIN'), key_func=email_and_ip)
+@limiter.limit(route_limit('LOGIN_IP'))
 @log_route
 def login():
     """
@@ -104,29 +115,28 @@ def login():
             refresh_token: string
             message: User logged in successfully
       400:
-        description: Missing required fields
+        description: Missing or invalid fields
         examples:
           application/json:
-            message: Missing required fields
+            error: Bad Request
+            message:
+              - field: email
+                error: Field required
       401:
         description: Invalid credentials
         examples:
           application/json:
             message: Invalid credentials
     """
-    data = request.get_json()
-
-    if not data or not data.get('email') or not data.get('password'):
-        return {'message': 'Missing required fields'}, 400
-
-    email = data['email']
-    password = data['password']
+    body = LoginRequest.from_request()
 
-    response, status = AuthService.authenticate_user(email, password)
+    response, status = AuthService.authenticate_user(body.email, body.password)
     return response, status
 
 @auth_bp.route('/reset-password', methods=['POST'])
-@jwt_required()
+@body_limit('PASSWORD')
+@limiter.limit(route_limit('PASSWORD'), key_func=identity_or_ip)
+@auth_required()
 @log_route
 def reset_password():
     """
@@ -154,25 +164,25 @@ def reset_password():
           application/json:
             message: Password updated successfully
       400:
-        description: Missing required fields or validation errors
+        description: Missing or invalid fields
         examples:
           application/json:
-            message: Missing required fields
+            error: Bad Request
+            message:
+              - field: new_password
+                error: Field required
     """
-    user_id = get_jwt_identity()
-    data = request.get_json()
+    user_id = current_identity()
+    body = ResetPasswordRequest.from_request()
 
-    if not data or not data.get('new_password'):
-        return {'message': 'Missing required fields'}, 400
-
-    new_password = data['new_password']
-
-    response, status = AuthService.update_password(user_id, new_password)
+    response, status = AuthService.update_password(user_id, body.new_password)
     return response, status
 
 # Endpoint to change password
 @auth_bp.route('/change-password', methods=['POST'])
-@jwt_required()
+@body_limit('PASSWORD')
+@limiter.limit(route_limit('PASSWORD'), key_func=identity_or_ip)
+@auth_required()
 @log_route
 def change_password():
     """
@@ -203,30 +213,29 @@ def change_password():
           application/json:
             message: Password updated successfully
       400:
-        description: Missing required fields or validation errors
+        description: Missing or invalid fields
         examples:
           application/json:
-            message: Missing required fields
+            error: Bad Request
+            message:
+              - field: current_password
+                error: Field required
       401:
         description: Invalid current password
         examples:
           application/json:
             message: Invalid current password
     """
-    user_id = get_jwt_identity()
-    data = request.get_json()
-
-    if not data or not data.get('current_password') or not data.get('new_password'):
-        return {'message': 'Missing required fields'}, 400
+    user_id = current_identity()
+    body = ChangePasswordRequest.from_request()
 
-    current_password = data['current_password']
-    new_password = data['new_password']
-
-    response, status = AuthService.change_password(user_id, current_password, new_password)
+    response, status = AuthService.change_password(
+        user_id, body.current_password, body.new_password)
     return response, status
 
 @auth_bp.route('/refresh', methods=['POST'])
-@jwt_required(refresh=True)
+@limiter.limit(route_limit('REFRESH'))
+@auth_required(refresh=True)
 @log_route
 def refresh():
     """
@@ -250,10 +259,119 @@ def refresh():
           application/json:
             message: Invalid token
     """
-    current_user = get_jwt_identity()
-    jti = get_jwt()['jti']
-    # Extract the token from the header
-    refresh_token = request.headers.get('Authorization').split()[1]
-    user_info = {'sub': current_user, 'jti': jti, 'token': refresh_token}
+    current_user = current_identity()
+    jti = current_claims()['jti']
+    user_info = {'sub': current_user, 'jti': jti}
     response, status = AuthService.refresh_token(user_info)
     return response, status
+
+@auth_bp.route('/logout', methods=['POST'])
+@auth_required()
+@log_route
+def logout():
+    """
+    Endpoint to revoke the access token used for the request
+    ---
+    security:
+      - Bearer: []
+    tags:
+      - auth
+    responses:
+      200:
+        description: User logged out successfully
+        examples:
+          application/json:
+            message: User logged out successfully
+      401:
+        description: Missing or revoked token
+        examples:
+          application/json:
+            msg: Token has been revoked
+    """
+    response, status = AuthService.logout(current_claims())
+    return response, status
+
+@auth_bp.route('/introspect', methods=['POST'])
+@body_limit('INTROSPECT')
+@limiter.limit(route_limit('INTROSPECT'))
+@log_route
+def introspect():
+    """
+    Endpoint to check whether tokens are active (RFC 7662 style)
+    ---
+    description: >
+      Send one token as form field or JSON "token", or up to
+      INTROSPECTION_MAX_TOKENS tokens as JSON "tokens" to get one result
+      per token in the same order. The caller must authenticate with HTTP
+      Basic client credentials from INTROSPECTION_CLIENTS, unless
+      INTROSPECTION_ALLOW_ANONYMOUS is set and no clients are configured.
+    parameters:
+      - in: body
+        name: body
+        schema:
+          type: object
+          properties:
+            token:
+              type: string
+            tokens:
+              type: array
+              items:
+                type: string
+    tags:
+      - auth
+    responses:
+      200:
+        description: Introspection result, or a list of results for a batch
+        examples:
+          application/json:
+            results:
+              - active: true
+                sub: 3f0c2a9e6b1d4c7a8e5f0b2d4c6a8e1f
+                exp: 1760000900
+                iat: 1760000000
+                jti: 9d7c5a3b1e0f4d2c8b6a4e2f0c9d7b5a
+                token_type: access_token
+              - active: false
+      400:
+        description: Missing token or too many tokens
+        examples:
+          application/json:
+            message: Missing token
+      401:
+        description: Missing or invalid client credentials
+        examples:
+          application/json:
+            message: Invalid client credentials
+    """
+    if not _introspection_client_allowed():
+        return ({'message': 'Invalid client credentials'}, 401,
+                {'WWW-Authenticate': 'Basic realm="introspect"'})
+
+    data = request.get_json(silent=True) if request.is_json else request.form
+    data = data if hasattr(data, 'get') else {}
+    batch = data.get('tokens')
+    tokens = batch if batch is not None else [data.get('token')]
+    if not isinstance(tokens, list) or not tokens or not all(
+            isinstance(token, str) and token for token in tokens):
+        return {'message': 'Missing token'}, 400
+    if len(tokens) > current_app.config['INTROSPECTION_MAX_TOKENS']:
+        return {'message': 'Too many tokens'}, 400
+
+    results = AuthService.introspect(tokens)
+    return ({'results': results} if batch is not None else results[0]), 200
+
+def _introspection_client_allowed():
+    '''Check HTTP Basic credentials against INTROSPECTION_CLIENTS.
+
+    RFC 7662 requires callers to authenticate, so without configured
+    clients only an explicit INTROSPECTION_ALLOW_ANONYMOUS lets them in.
+    '''
+    clients = current_app.config['INTROSPECTION_CLIENTS']
+    if not clients:
+        return current_app.config['INTROSPECTION_ALLOW_ANONYMOUS']
+    credentials = request.authorization
+    if credentials is None or credentials.type != 'basic':
+        return False
+    secret = clients.get(credentials.username)
+    return secret is not None and hmac.compare_digest(
+        secret.encode('utf-8'), (credentials.password or '').encode('utf-8'))
@@ -0,0 +1,23 @@
+'''Prometheus scrape endpoint'''
+from flask import Blueprint, Response
+from auth import limiter
+from auth.utils.metrics import metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+@limiter.exempt
+def scrape():
+    """
+    Request, database, password hashing and token metrics of every worker
+    ---
+    tags:
+      - monitoring
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Metrics in the Prometheus text exposition format
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
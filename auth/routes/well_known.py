@@ -0,0 +1,38 @@
+'''Public discovery documents for resource servers'''
+from flask import Blueprint, Response, request
+from auth import key_ring, limiter
+
+well_known_bp = Blueprint('well_known', __name__)
+
+
+@well_known_bp.route('/jwks.json', methods=['GET'])
+@limiter.exempt
+def jwks():
+    """
+    JSON Web Key Set with the public keys that sign access and refresh tokens
+    ---
+    tags:
+      - auth
+    responses:
+      200:
+        description: The published signing keys, selected by the token's kid header
+        examples:
+          application/json:
+            keys:
+              - kty: OKP
+                crv: Ed25519
+                x: 11qYAYKxCrfVS_7TyWQHOg7hcvPapiMlrwIaaPcHURo
+                kid: 1760000000-3f9a1c2b
+                alg: EdDSA
+                use: sig
+      304:
+        description: The key set matches If-None-Match
+    """
+    body, etag = key_ring.jwks()
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': f'public, max-age={key_ring.jwks_max_age}',
+    }
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
@@ -0,0 +1 @@
+'''Request body schemas'''
@@ -0,0 +1,112 @@
+'''Request schemas for the auth routes.
+
+Each route parses its JSON body with one of these before doing any
+other work. Missing fields, wrong types and over-long values are
+rejected by pydantic's compiled core before the format validators run,
+and a pydantic ValidationError becomes a 400 in errors.handlers.
+'''
+from flask import current_app, request
+from pydantic import BaseModel, ConfigDict, Field, StrictStr, field_validator
+from pydantic_core import PydanticCustomError
+from auth.utils.validation import (
+    EMAIL_VALIDATION_ERROR, PASSWORD_VALIDATION_ERROR, USERNAME_VALIDATION_ERROR,
+    validate_email, validate_password, validate_username
+)
+
+USERNAME_MAX_LENGTH = 20
+EMAIL_MAX_LENGTH = 120
+PASSWORD_MAX_LENGTH = 128
+
+
+class RequestSchema(BaseModel):
+    '''Base class: unknown fields are ignored, values are never coerced.
+
+    Validators are compiled on first use rather than at import, so a
+    worker only pays for the schemas its requests actually touch.
+    '''
+    model_config = ConfigDict(extra='ignore', strict=True, defer_build=True)
+
+    @classmethod
+    def from_request(cls):
+        '''Validate the current request's JSON body'''
+        data = request.get_json(silent=True)
+        return cls.model_validate(data if isinstance(data, dict) else {})
+
+
+def _password_bytes(value):
+    '''Reject passwords over PASSWORD_MAX_BYTES before they reach the hasher'''
+    limit = current_app.config.get('PASSWORD_MAX_BYTES')
+    if limit and len(value.encode('utf-8')) > limit:
+        raise PydanticCustomError(
+            'password_too_long', 'Password is limited to {limit} bytes', {'limit': limit})
+    return value
+
+
+def _password(value):
+    _password_bytes(value)
+    if not validate_password(value):
+        raise PydanticCustomError('password_format', PASSWORD_VALIDATION_ERROR)
+    return value
+
+
+class RegisterRequest(RequestSchema):
+    '''POST /register'''
+    username: StrictStr = Field(min_length=1, max_length=USERNAME_MAX_LENGTH)
+    email: StrictStr = Field(min_length=1, max_length=EMAIL_MAX_LENGTH)
+    password: StrictStr = Field(min_length=1, max_length=PASSWORD_MAX_LENGTH)
+
+    @field_validator('username')
+    @classmethod
+    def check_username(cls, value):
+        '''Alphanumeric characters and underscores only'''
+        if not validate_username(value):
+            raise PydanticCustomError('username_format', USERNAME_VALIDATION_ERROR)
+        return value
+
+    @field_validator('email')
+    @classmethod
+    def check_email(cls, value):
+        '''A plausible email address'''
+        if not validate_email(value):
+            raise PydanticCustomError('email_format', EMAIL_VALIDATION_ERROR)
+        return value
+
+    @field_validator('password')
+    @classmethod
+    def check_password(cls, value):
+        '''Password strength rules'''
+        return _password(value)
+
+
+class LoginRequest(RequestSchema):
+    '''POST /login; formats aren't checked so old accounts can still log in'''
+    email: StrictStr = Field(min_length=1, max_length=EMAIL_MAX_LENGTH)
+    password: StrictStr = Field(min_length=1, max_length=PASSWORD_MAX_LENGTH)
+
+    @field_validator('password')
+    @classmethod
+    def check_password(cls, value):
+        '''Byte limit only'''
+        return _password_bytes(value)
+
+
+class ResetPasswordRequest(RequestSchema):
+    '''POST /reset-password'''
+    new_password: StrictStr = Field(min_length=1, max_length=PASSWORD_MAX_LENGTH)
+
+    @field_validator('new_password')
+    @classmethod
+    def check_new_password(cls, value):
+        '''Password strength rules'''
+        return _password(value)
+
+
+class ChangePasswordRequest(ResetPasswordRequest):
+    '''POST /change-password'''
+    current_password: StrictStr = Field(min_length=1, max_length=PASSWORD_MAX_LENGTH)
+
+    @field_validator('current_password')
+    @classmethod
+    def check_current_password(cls, value):
+        '''Byte limit only'''
+        return _password_bytes(value)
@@ -1,27 +1,47 @@
 '''AuthService with business logic for the auth routes'''
+import hashlib
+import time
 from datetime import timedelta, datetime, timezone
 from flask_jwt_extended import create_access_token, create_refresh_token, decode_token
-from auth import db
-from auth.utils.validation import validate_email, validate_password, validate_username
-from auth.utils.logger import log_success
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+from sqlalchemy import or_, select
+from sqlalchemy.exc import IntegrityError
+from auth import db, hasher
+from auth.utils.identity import token_cache
+from auth.utils.ttl_cache import TTLCache
+from auth.utils.user_cache import user_cache
+from auth.utils.validation import (
+    EMAIL_VALIDATION_ERROR, PASSWORD_VALIDATION_ERROR, USERNAME_VALIDATION_ERROR,
+    normalize_email, validate_email, validate_password, validate_username
+)
+from auth.utils.logger import log_warning
+from auth.utils.metrics import REFRESH_TOKEN_REUSE
+from ..models.base import get_uuid
 from ..models.models import User, RefreshToken
+from .revocation import revocation_list
+from .unit_of_work import transactional
 
-PASSWORD_VALIDATION_ERROR = 'Password must be at least 8 char, at least one letter and one number'
+ACCESS_TOKEN_EXPIRES = timedelta(minutes=15)
+REFRESH_TOKEN_EXPIRES = timedelta(minutes=60)
+
+# Introspection results keyed by the SHA-256 of the token; configured
+# from INTROSPECTION_CACHE_SIZE/TTL in create_app
+introspection_cache = TTLCache()
 
 class AuthService:
-    '''Contains the business logic for the auth routes'''
+    '''Contains the business logic for the auth routes
+
+    Public methods are transactional: everything they write is committed
+    once when they return, or rolled back if they raise.
+    '''
 
     @staticmethod
+    @transactional
     def register_user(username, email, password):
         '''Registers a new user'''
-        if User.query.filter_by(username=username).first():
-            return {'message': 'Username already exists'}, 400
-
-        if User.query.filter_by(email=email).first():
-            return {'message': 'Email already exists'}, 400
-
         if not validate_email(email):
-            return {'message': 'Invalid email address'}, 400
+            return {'message': EMAIL_VALIDATION_ERROR}, 400
 
         if not validate_password(password):
             return {
@@ -30,28 +50,52 @@ class AuthService:
 
         if not validate_username(username):
             return {
-                'message': 'Username can only contain alphanumeric characters and underscores'
+                'message': USERNAME_VALIDATION_ERROR
                 }, 400
 
+        # One query for both unique columns before paying for the hash;
+        # the unique constraints still decide concurrent registrations
+        taken = db.session.execute(
+            select(User.username)
+            .where(or_(User.username == username,
+                       User.email_normalized == normalize_email(email)))
+            .limit(2)
+            ).all()
+        if any(row.username == username for row in taken):
+            return {'message': 'Username already exists'}, 400
+        if taken:
+            return {'message': 'Email already exists'}, 400
+
         new_user = User(username=username, email=email)
         new_user.set_password(password)
 
         new_user.insert()
+        try:
+            db.session.flush()
+        except IntegrityError as e:
+            db.session.rollback()
+            message = AuthService._unique_violation_message(e)
+            if message is None:
+                raise
+            return {'message': message}, 400
         return {'message': 'User registered successfully'}, 201
 
     @staticmethod
+    @transactional
     def authenticate_user(email, password):
         '''Authenticate a user'''
-        user = User.query.filter_by(email=email).first()
+        user, row = AuthService._user_by_email(normalize_email(email))
 
-        if not user or not user.check_password(password):
+        if not user or not hasher.verify(user['password_hash'], password):
             return {'message': 'Invalid credentials'}, 401
 
-        access_token = AuthService._create_access_token(user.id)
-        refresh_token = AuthService._create_refresh_token(user.id)
+        # Upgrade the stored hash while we have the plaintext password
+        if hasher.needs_rehash(user['password_hash']):
+            (row or db.session.get(User, user['id'])).set_password(password)
 
-        # Store the new refresh token in the database
-        AuthService._store_refresh_token(refresh_token)
+        access_token = AuthService._create_access_token(user['id'])
+        # A login starts a new refresh token family
+        refresh_token = AuthService._issue_refresh_token(user['id'], get_uuid())
 
         return {
             'access_token': access_token,
@@ -60,52 +104,88 @@ class AuthService:
         }, 200
 
     @staticmethod
+    @transactional
     def update_password(user_id, new_password):
         '''Updates a user's password'''
         if not validate_password(new_password):
             return {
                 'message': PASSWORD_VALIDATION_ERROR 
                 }, 400
-        user = User.query.get(user_id)
-        user.set_password(new_password)
+        user, row = AuthService._user_by_id(user_id)
+        if user is None:
+            return {'message': 'User not found'}, 404
+        (row or db.session.get(User, user_id)).set_password(new_password)
+        # Tokens issued with the old password must stop working
+        revocation_list.revoke_user_tokens(user_id)
+        introspection_cache.evict(lambda result: result.get('sub') == user_id)
         return {'message': 'Password updated successfully'}, 200
 
     @staticmethod
+    @transactional
     def change_password(user_id, current_password, new_password):
         '''Changes a user's password'''
         if not validate_password(new_password):
             return {
                 'message': PASSWORD_VALIDATION_ERROR 
                 }, 400
-        user = User.query.get(user_id)
-        if not user.check_password(current_password):
-            return {'message': 'Invalid current password'}, 401
-        user.set_password(new_password)
+        user, row = AuthService._user_by_id(user_id)
+        if user is None:
+            return {'message': 'User not found'}, 404
+        if not hasher.verify(user['password_hash'], current_password):
+            if row is not None:
+                return {'message': 'Invalid current password'}, 401
+            # The hash came from the cache: reject only if it wasn't stale
+            stored, row = AuthService._user_by_id(user_id, fresh=True)
+            if stored is None or stored['password_hash'] == user['password_hash'] \
+                    or not hasher.verify(stored['password_hash'], current_password):
+                return {'message': 'Invalid current password'}, 401
+        (row or db.session.get(User, user_id)).set_password(new_password)
+        # Tokens issued with the old password must stop working
+        revocation_list.revoke_user_tokens(user_id)
+        introspection_cache.evict(lambda result: result.get('sub') == user_id)
         return {'message': 'Password updated successfully'}, 200
 
     @staticmethod
+    @transactional
+    def logout(claims):
+        '''Revokes the access token used for the request'''
+        revocation_list.revoke_token(
+            claims['jti'],
+            claims['sub'],
+            datetime.fromtimestamp(claims['exp'], tz=timezone.utc)
+            )
+        introspection_cache.evict(lambda result: result.get('jti') == claims['jti'])
+        return {'message': 'User logged out successfully'}, 200
+
+    @staticmethod
+    @transactional
     def refresh_token(user_info):
         '''Refreshes the access token and issues a new refresh token'''
         # Invalidate the old refresh token
-        old_token = RefreshToken.query.filter_by(
-            token=user_info['token'],
-            user_id=user_info['sub']
-            ).first()
-        if old_token:
-            if old_token.used:
-                return {'message': 'Invalid token'}, 401
-            old_token.used = True
-            db.session.commit()
-        else:
+        old_token = RefreshToken.query.filter_by(jti=user_info['jti']).first()
+        if not old_token or old_token.user_id != user_info['sub']:
             return {'message': 'Token not found'}, 401
+        # Claim the token with one conditional UPDATE, so of two concurrent
+        # refreshes with the same token only one can rotate it
+        claimed = RefreshToken.query.filter_by(jti=old_token.jti, used=False).update(
+            {'used': True}, synchronize_session=False)
+        if not claimed:
+            # A rotated token was presented again: it has leaked, so revoke
+            # every token descended from the same login
+            AuthService._revoke_token_family(old_token.family_id)
+            REFRESH_TOKEN_REUSE.inc()
+            introspection_cache.evict(lambda result: result.get('sub') == old_token.user_id)
+            log_warning(
+                'refresh_token()',
+                f"Reuse of refresh token {old_token.jti} detected, "
+                f"revoked family {old_token.family_id} of {old_token.user_id}")
+            return {'message': 'Invalid token'}, 401
+        introspection_cache.evict(lambda result: result.get('jti') == old_token.jti)
 
-        # Create new access and refresh tokens
+        # Create new access and refresh tokens in the same family
         new_access_token = AuthService._create_access_token(user_info['sub'])
-        new_refresh_token = AuthService._create_refresh_token(user_info['sub'])
-
-
-        # Store the new refresh token in the database
-        AuthService._store_refresh_token(new_refresh_token)
+        new_refresh_token = AuthService._issue_refresh_token(
+            user_info['sub'], old_token.family_id)
 
         return {
             'access_token': new_access_token,
@@ -113,48 +193,158 @@ class AuthService:
             'message': 'Tokens refreshed successfully'
         }, 200
 
+    @staticmethod
+    def introspect(tokens):
+        '''Reports whether each token is active, in the style of RFC 7662.
+
+        Signatures, expiry and revocation are checked in memory; the
+        state of every refresh token in the batch comes from a single
+        query. Results are cached for INTROSPECTION_CACHE_TTL seconds.
+        '''
+        results = [None] * len(tokens)
+        pending = {}
+        for index, token in enumerate(tokens):
+            key = hashlib.sha256(token.encode('utf-8')).digest()
+            cached = introspection_cache.get(key)
+            if cached is not None:
+                results[index] = cached
+            else:
+                pending.setdefault(key, []).append(index)
+
+        decoded = {}
+        for key, indexes in pending.items():
+            claims = AuthService._verified_claims(tokens[indexes[0]])
+            if claims is None or revocation_list.is_revoked(claims):
+                decoded[key] = None
+            else:
+                decoded[key] = claims
+
+        refresh_jtis = [claims['jti'] for claims in decoded.values()
+                        if claims is not None and claims.get('type') == 'refresh']
+        refresh_state = {}
+        if refresh_jtis:
+            rows = db.session.execute(
+                select(RefreshToken.jti, RefreshToken.user_id, RefreshToken.used)
+                .where(RefreshToken.jti.in_(refresh_jtis)))
+            refresh_state = {row.jti: row for row in rows}
+
+        for key, indexes in pending.items():
+            claims = decoded[key]
+            if claims is not None and claims.get('type') == 'refresh':
+                row = refresh_state.get(claims['jti'])
+                if row is None or row.used or row.user_id != claims['sub']:
+                    claims = None
+            result = AuthService._introspection_result(claims)
+            introspection_cache.put(key, result, claims and claims.get('exp'))
+            for index in indexes:
+                results[index] = result
+        return results
+
     # Private Helper Methods
     @staticmethod
-    def _create_access_token(user_id):
-        '''Creates an access token'''
-        return create_access_token(identity=user_id, expires_delta=timedelta(minutes=15))
+    def _user_by_email(email_normalized):
+        '''(user cache entry, User row) for this normalized email.
+
+        The row is None when the entry came from the user cache; both are
+        None when there is no such user.
+        '''
+        user = user_cache.get_by_email(email_normalized)
+        if user is not None:
+            return user, None
+        # Never the replica: a lagging copy could still accept an old password
+        row = db.session.execute(
+            select(User).filter_by(email_normalized=email_normalized)
+            ).scalar_one_or_none()
+        return (user_cache.put(row), row) if row is not None else (None, None)
+
+    @staticmethod
+    def _user_by_id(user_id, fresh=False):
+        '''(user cache entry, User row) for this id, like _user_by_email.
+
+        fresh=True skips the cache and rereads the row from the primary.
+        '''
+        user = None if fresh else user_cache.get_by_id(user_id)
+        if user is not None:
+            return user, None
+        row = db.session.get(User, user_id, populate_existing=fresh)
+        return (user_cache.put(row), row) if row is not None else (None, None)
+
+    @staticmethod
+    def _unique_violation_message(error):
+        '''The registration message for a unique constraint violation on users, or None'''
+        # Constraint/column names appear in the driver message on SQLite,
+        # PostgreSQL and MySQL alike
+        detail = str(error.orig).lower()
+        if 'username' in detail:
+            return 'Username already exists'
+        if 'email' in detail:
+            return 'Email already exists'
+        return None
 
     @staticmethod
-    def _create_refresh_token(user_id):
-        '''Creates a refresh token'''
-        return create_refresh_token(identity=user_id, expires_delta=timedelta(minutes=60))
+    def _verified_claims(token):
+        '''The claims of a validly signed, unexpired token, or None'''
+        claims = token_cache.get(token)
+        if claims is not None:
+            return claims
+        try:
+            return decode_token(token)
+        except (JWTExtendedException, PyJWTError):
+            return None
 
     @staticmethod
-    def _store_refresh_token(refresh_token):
-        '''Stores the new refresh token in the database'''
-        # Decode the new refresh token to get the expiry date
-        decoded_refresh_token = decode_token(refresh_token)
-        expires_at = datetime.fromtimestamp(decoded_refresh_token['exp'], tz=timezone.utc)
-        user_id = decoded_refresh_token['sub']
+    def _introspection_result(claims):
+        '''The introspection response for a token's claims (None when inactive)'''
+        if claims is None:
+            return {'active': False}
+        result = {
+            'active': True,
+            'sub': claims['sub'],
+            'exp': int(claims['exp']),
+            'iat': int(claims['iat']),
+            'jti': claims['jti'],
+            'token_type': f"{claims.get('type', 'access')}_token",
+        }
+        if claims.get('scope'):
+            result['scope'] = claims['scope']
+        return result
+
+    @staticmethod
+    def _create_access_token(user_id):
+        '''Creates an access token'''
+        # Sub-second iat so per-user revocation cutoffs are exact
+        return create_access_token(
+            identity=user_id,
+            expires_delta=ACCESS_TOKEN_EXPIRES,
+            additional_claims={'iat': time.time()}
+            )
+
+    @staticmethod
+    def _issue_refresh_token(user_id, family_id):
+        '''Creates a refresh token and stores its jti in the database'''
+        # Choose jti and exp here so the token never has to be decoded again
+        jti = get_uuid()
+        expires_at = datetime.now(timezone.utc) + REFRESH_TOKEN_EXPIRES
+        refresh_token = create_refresh_token(
+            identity=user_id,
+            expires_delta=REFRESH_TOKEN_EXPIRES,
+            additional_claims={
+                'jti': jti, 'fam': family_id, 'iat': time.time(), 'exp': expires_at}
+            )
 
         # Store the new refresh token in the database
         new_token = RefreshToken(
-            token=refresh_token,
+            jti=jti,
+            family_id=family_id,
             user_id=user_id,
             used=False,
             expires_at=expires_at
             )
         new_token.insert()
-
-        # Delete all expired refresh tokens of a user
-        AuthService.delete_expired_refresh_tokens(user_id)
+        return refresh_token
 
     @staticmethod
-    def delete_expired_refresh_tokens(user_id):
-        '''Deletes expired refresh tokens of a user'''
-        now = datetime.now(timezone.utc)
-        expired_tokens = RefreshToken.query.filter(
-            RefreshToken.user_id == user_id,
-            RefreshToken.expires_at < now
-            ).all()
-        for token in expired_tokens:
-            db.session.delete(token)
-            log_success(
-                'delete_expired_refresh_tokens()', 
-                f"{token.token} belonging to {user_id} has expired and deleted successfully")
-        db.session.commit()
+    def _revoke_token_family(family_id):
+        '''Marks every unused refresh token of a family as used'''
+        RefreshToken.query.filter_by(family_id=family_id, used=False).update(
+            {'used': True}, synchronize_session=False)
@@ -0,0 +1,167 @@
+'''Access and refresh token revocation'''
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from auth import db
+from auth.utils.bloom import BloomFilter
+from auth.utils.identity import token_cache
+from auth.utils.logger import log_error
+from ..models.models import RevokedToken, TokenCutoff
+
+
+class RevocationList:  # pylint: disable=too-many-instance-attributes
+    '''Answers "is this token revoked?" without a query in the common case.
+
+    Two kinds of revocation are stored in the database: single tokens by
+    jti (RevokedToken) and per-user cutoffs that revoke every token
+    issued before a time (TokenCutoff). Each process keeps the recent
+    cutoffs in a dict and the revoked jtis in a bloom filter, refreshed
+    by an incremental sync at most every sync_interval seconds. A jti
+    that isn't in the bloom filter is not revoked; only possible hits are
+    confirmed against the database, and the answers are kept in a small
+    LRU cache.
+    '''
+    # Rows written by other processes within this many seconds of the
+    # previous sync are fetched again in case their transaction was slow
+    SYNC_OVERLAP = 5
+
+    def __init__(self, app=None):
+        self.sync_interval = 5
+        self.rebuild_interval = 3600
+        self.cutoff_retention = 3600
+        self.bloom_capacity = 100000
+        self.bloom_error_rate = 0.001
+        self.cache_size = 1024
+        self._lock = threading.Lock()
+        # Synced state; init_app() starts it over with the configured sizes
+        self._bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        self._cutoffs = {}
+        self._confirmed = OrderedDict()
+        self._next_sync = 0
+        self._next_rebuild = 0
+        self._synced_at = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''Read the REVOCATION_* settings from the app config'''
+        self.sync_interval = app.config.get('REVOCATION_SYNC_INTERVAL', self.sync_interval)
+        self.rebuild_interval = app.config.get('REVOCATION_REBUILD_INTERVAL', self.rebuild_interval)
+        self.cutoff_retention = app.config.get('REVOCATION_CUTOFF_RETENTION', self.cutoff_retention)
+        self.bloom_capacity = app.config.get('REVOCATION_BLOOM_CAPACITY', self.bloom_capacity)
+        self.bloom_error_rate = app.config.get('REVOCATION_BLOOM_ERROR_RATE', self.bloom_error_rate)
+        self.cache_size = app.config.get('REVOCATION_CACHE_SIZE', self.cache_size)
+        self._reset()
+        app.extensions['revocation'] = self
+
+    def _reset(self):
+        self._bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        self._cutoffs = {}
+        self._confirmed = OrderedDict()
+        self._next_sync = 0
+        self._next_rebuild = 0
+        self._synced_at = None
+
+    def is_revoked(self, claims):
+        '''Check decoded token claims against the revocation list'''
+        self._sync_if_due()
+        cutoff = self._cutoffs.get(claims.get('sub'))
+        if cutoff is not None and claims.get('iat', 0) < cutoff:
+            return True
+        jti = claims.get('jti')
+        if not jti or jti not in self._bloom:
+            return False
+        return self._confirm(jti)
+
+    def revoke_token(self, jti, user_id, expires_at):
+        '''Revoke a single token; the caller commits'''
+        RevokedToken(jti=jti, user_id=user_id, expires_at=expires_at).insert()
+        self._bloom.add(jti)
+        self._remember(jti, True)
+        token_cache.evict_jti(jti)
+
+    def revoke_user_tokens(self, user_id):
+        '''Revoke every token issued to the user so far; the caller commits'''
+        # AuthService issues tokens with a sub-second iat, so a login right
+        # after this call is not caught by the cutoff
+        not_before = time.time()
+        cutoff = TokenCutoff.query.filter_by(user_id=user_id).first()
+        if cutoff is None:
+            TokenCutoff(user_id=user_id, not_before=not_before).insert()
+        else:
+            cutoff.not_before = not_before
+            cutoff.update()
+        self._cutoffs[user_id] = not_before
+        token_cache.evict_identity(user_id, issued_before=not_before)
+
+    def _confirm(self, jti):
+        '''Look a bloom filter hit up in the LRU cache, then the database'''
+        with self._lock:
+            if jti in self._confirmed:
+                self._confirmed.move_to_end(jti)
+                return self._confirmed[jti]
+        revoked = db.session.query(
+            RevokedToken.query.filter_by(jti=jti).exists()).scalar()
+        self._remember(jti, revoked)
+        return revoked
+
+    def _remember(self, jti, revoked):
+        with self._lock:
+            self._confirmed[jti] = revoked
+            self._confirmed.move_to_end(jti)
+            while len(self._confirmed) > self.cache_size:
+                self._confirmed.popitem(last=False)
+
+    def _sync_if_due(self):
+        now = time.monotonic()
+        # A non-blocking acquire has no with form: one request syncs while
+        # the others keep answering from the current state
+        if now < self._next_sync or not self._lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+            return
+        try:
+            self._next_sync = now + self.sync_interval
+            full = now >= self._next_rebuild
+            if full:
+                self._next_rebuild = now + self.rebuild_interval
+            self._sync(full)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Keep answering from the last good state until the next sync
+            log_error('RevocationList._sync()', f"Revocation sync failed: {e}")
+        finally:
+            self._lock.release()
+
+    def _sync(self, full):
+        '''Load revocations created since the last sync, or all live ones when full'''
+        # created_at/updated_at are written with local naive datetime.now()
+        started = datetime.now()
+        revoked = RevokedToken.query.with_entities(RevokedToken.jti).filter(
+            RevokedToken.expires_at > datetime.now(timezone.utc))
+        cutoffs = TokenCutoff.query.with_entities(
+            TokenCutoff.user_id, TokenCutoff.not_before).filter(
+            TokenCutoff.not_before > time.time() - self.cutoff_retention)
+        if not full and self._synced_at is not None:
+            since = datetime.fromtimestamp(self._synced_at.timestamp() - self.SYNC_OVERLAP)
+            revoked = revoked.filter(RevokedToken.created_at >= since)
+            cutoffs = cutoffs.filter(TokenCutoff.updated_at >= since)
+
+        jtis = [row.jti for row in revoked]
+        if full:
+            bloom = BloomFilter(max(self.bloom_capacity, 2 * len(jtis)), self.bloom_error_rate)
+            new_cutoffs = {}
+        else:
+            bloom, new_cutoffs = self._bloom, dict(self._cutoffs)
+        for jti in jtis:
+            bloom.add(jti)
+            self._confirmed.pop(jti, None)
+        for row in cutoffs:
+            new_cutoffs[row.user_id] = row.not_before
+        horizon = time.time() - self.cutoff_retention
+        self._cutoffs = {user: at for user, at in new_cutoffs.items() if at > horizon}
+        if full:
+            self._bloom = bloom
+            self._confirmed.clear()
+        self._synced_at = started
+
+
+revocation_list = RevocationList()
@@ -0,0 +1,97 @@
+'''Removes expired refresh tokens and revocations outside of the request path'''
+import threading
+import time
+from datetime import datetime, timezone
+from sqlalchemy import delete, select
+from auth import db
+from auth.utils.logger import log_error, log_success
+from ..models.models import RefreshToken, RevokedToken
+
+
+def _sweep_expired(model, batch_size, max_batches):
+    '''Deletes rows of model whose expires_at has passed, batch_size at a time'''
+    now = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    deleted = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = db.session.execute(
+            select(model.id)
+            .where(model.expires_at < now)
+            .limit(batch_size)
+            ).scalars().all()
+        if not ids:
+            break
+        db.session.execute(
+            delete(model).where(model.id.in_(ids)),
+            execution_options={'synchronize_session': False}
+            )
+        db.session.commit()
+        deleted += len(ids)
+        batches += 1
+        if len(ids) < batch_size:
+            break
+    elapsed = time.perf_counter() - started
+    return {
+        'deleted': deleted,
+        'batches': batches,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(deleted / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def sweep_expired_refresh_tokens(batch_size=1000, max_batches=None):
+    '''Deletes expired refresh tokens in bounded batches.
+
+    Used tokens are removed along with the rest once they expire; until
+    then they are kept so that reuse of a rotated token can still be
+    detected. Each batch is its own short transaction, so the sweep
+    never holds locks on more than batch_size rows.
+
+    Returns a dict with the number of deleted rows, batches, elapsed
+    seconds and rows per second.
+    '''
+    return _sweep_expired(RefreshToken, batch_size, max_batches)
+
+
+def sweep_expired_revocations(batch_size=1000, max_batches=None):
+    '''Deletes revocations of tokens that have expired anyway, like sweep_expired_refresh_tokens'''
+    return _sweep_expired(RevokedToken, batch_size, max_batches)
+
+
+class TokenSweeper(threading.Thread):
+    '''Daemon thread that sweeps expired refresh tokens and revocations every interval seconds'''
+
+    def __init__(self, app, interval, batch_size=1000):
+        super().__init__(name='refresh-token-sweeper', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    stats = sweep_expired_refresh_tokens(self.batch_size)
+                    revocations = sweep_expired_revocations(self.batch_size)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    db.session.rollback()
+                    log_error('TokenSweeper.run()', f"Sweep failed: {e}")
+                    continue
+                finally:
+                    db.session.remove()
+            if stats['deleted']:
+                log_success(
+                    'TokenSweeper.run()',
+                    f"Deleted {stats['deleted']} expired refresh tokens "
+                    f"({stats['rows_per_second']} rows/sec)")
+            if revocations['deleted']:
+                log_success(
+                    'TokenSweeper.run()',
+                    f"Deleted {revocations['deleted']} expired revocations "
+                    f"({revocations['rows_per_second']} rows/sec)")
+
+    def stop(self):
+        '''Ask the sweeper to exit after the current sweep'''
+        self._stop_event.set()
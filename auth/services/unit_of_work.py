@@ -0,0 +1,40 @@
+'''Unit of work: one transaction per service call'''
+from contextlib import contextmanager
+from functools import wraps
+from auth import db
+
+_DEPTH_KEY = 'unit_of_work_depth'
+
+
+@contextmanager
+def unit_of_work():
+    '''Commit everything written inside the block in a single transaction.
+
+    Models only stage changes (BaseModel.insert/update/delete never
+    commit), so a login or refresh that stores a token, marks the old
+    one used and rehashes the password costs one commit. On any
+    exception the whole transaction is rolled back. Nested blocks join
+    the outermost one, which is the only one that commits.
+    '''
+    session = db.session()
+    depth = session.info.get(_DEPTH_KEY, 0)
+    session.info[_DEPTH_KEY] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except Exception:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        session.info[_DEPTH_KEY] = depth
+
+
+def transactional(func):
+    '''Run the decorated function inside unit_of_work()'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with unit_of_work():
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,269 @@
+'''Bulk user import and export for migrations from other systems'''
+import csv
+import json
+import os
+import time
+from datetime import datetime
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from auth import db, hasher
+from auth.utils.database import read_only
+from auth.utils.validation import (
+    normalize_email, validate_email, validate_password, validate_username
+)
+from ..models.base import get_uuid
+from ..models.models import User
+
+FORMATS = ('csv', 'jsonl')
+EXPORT_FIELDS = ('id', 'username', 'email', 'created_at')
+USERNAME_MAX_LENGTH = User.__table__.c.username.type.length
+EMAIL_MAX_LENGTH = User.__table__.c.email.type.length
+
+
+def format_for(path, default='csv'):
+    '''Guess csv or jsonl from a file name'''
+    extension = os.path.splitext(path or '')[1].lower().lstrip('.')
+    if extension in ('jsonl', 'ndjson'):
+        return 'jsonl'
+    return 'csv' if extension == 'csv' else default
+
+
+def read_records(stream, fmt):
+    '''Yield (line number, record dict) from a CSV (with header) or JSONL stream'''
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else {'_error': 'Invalid JSON'}
+
+
+def _validate(record):
+    '''Return (row, None) for a valid record or (None, reason)'''
+    if '_error' in record:
+        return None, record['_error']
+    fields = [record.get(field) or ''
+              for field in ('username', 'email', 'password', 'password_hash')]
+    # JSONL records can carry numbers, lists or objects where strings belong
+    if not all(isinstance(value, str) for value in fields):
+        return None, 'Fields must be strings'
+    username, email, password, password_hash = fields
+    username, email = username.strip(), email.strip()
+    if not username or not email or not (password or password_hash):
+        return None, 'Missing required fields'
+    if len(username) > USERNAME_MAX_LENGTH or not validate_username(username):
+        return None, 'Invalid username'
+    if len(email) > EMAIL_MAX_LENGTH or not validate_email(email):
+        return None, 'Invalid email address'
+    if password_hash:
+        # Hashes from the legacy system are kept if we can verify them;
+        # they are upgraded to the current algorithm on the next login
+        if hasher.identify(password_hash) is None:
+            return None, 'Unsupported password hash'
+    elif hasher.too_long(password):
+        return None, 'Password too long'
+    elif not validate_password(password):
+        return None, 'Invalid password'
+    return {
+        'username': username,
+        'email': email,
+        'email_normalized': normalize_email(email),
+        'password': None if password_hash else password,
+        'password_hash': password_hash or None,
+    }, None
+
+
+class Checkpoint:
+    '''Last input line whose batch was committed, kept in a small JSON file'''
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.line = 0
+        self.totals = {'imported': 0, 'skipped': 0}
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state.get('source') != source:
+                raise ValueError(f"Checkpoint {path} belongs to {state.get('source')}")
+            self.line = state['line']
+            self.totals = state['totals']
+
+    def save(self, line, totals):
+        '''Record progress atomically'''
+        self.line = line
+        self.totals = dict(totals)
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump({'source': self.source, 'line': line, 'totals': self.totals},
+                      checkpoint_file)
+        os.replace(temp_path, self.path)
+
+
+def _existing(usernames, emails):
+    '''Usernames and normalized emails of the batch that are already taken'''
+    rows = db.session.execute(
+        select(User.username, User.email_normalized)
+        .where(or_(User.username.in_(usernames), User.email_normalized.in_(emails))))
+    taken_usernames, taken_emails = set(), set()
+    for row in rows:
+        taken_usernames.add(row.username)
+        taken_emails.add(row.email_normalized)
+    return taken_usernames, taken_emails
+
+
+def _insert(accepted, reject):
+    '''Insert (line number, record, row) triples in one statement and commit; return the count'''
+    now = datetime.now()
+    values = [{
+        'id': get_uuid(),
+        'username': row['username'],
+        'email': row['email'],
+        'email_normalized': row['email_normalized'],
+        'password_hash': row['password_hash'],
+        'created_at': now,
+        'updated_at': now,
+    } for _, _, row in accepted]
+    if not values:
+        db.session.commit()
+        return 0
+    try:
+        db.session.execute(insert(User), values)
+        db.session.commit()
+        return len(values)
+    except IntegrityError:
+        db.session.rollback()
+    # Someone registered one of these users since _existing() looked:
+    # insert the batch row by row so only the conflicting records are lost
+    imported = 0
+    for (line_number, record, _), row in zip(accepted, values):
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(User), [row])
+            imported += 1
+        except IntegrityError:
+            reject(line_number, record, 'Username or email already exists')
+    db.session.commit()
+    return imported
+
+
+def _import_batch(batch, reject):
+    '''Insert the valid, unique records of a batch in one statement; return the count'''
+    candidates = []
+    seen_usernames, seen_emails = set(), set()
+    for line_number, record in batch:
+        row, reason = _validate(record)
+        if row is None:
+            reject(line_number, record, reason)
+        elif row['username'] in seen_usernames or row['email_normalized'] in seen_emails:
+            reject(line_number, record, 'Duplicate in input')
+        else:
+            seen_usernames.add(row['username'])
+            seen_emails.add(row['email_normalized'])
+            candidates.append((line_number, record, row))
+    if not candidates:
+        return 0
+
+    taken_usernames, taken_emails = _existing(seen_usernames, seen_emails)
+    accepted = []
+    for line_number, record, row in candidates:
+        if row['username'] in taken_usernames:
+            reject(line_number, record, 'Username already exists')
+        elif row['email_normalized'] in taken_emails:
+            reject(line_number, record, 'Email already exists')
+        else:
+            accepted.append((line_number, record, row))
+
+    plaintext = [row for _, _, row in accepted if row['password'] is not None]
+    hashes = hasher.hash_many([row['password'] for row in plaintext])
+    for row, password_hash in zip(plaintext, hashes):
+        row['password_hash'] = password_hash
+    return _insert(accepted, reject)
+
+
+def import_users(records, batch_size=1000, checkpoint=None, on_reject=None, on_progress=None):
+    '''Import users from an iterable of (line number, record) pairs.
+
+    Records need username, email and either a plaintext password (hashed
+    with the current algorithm, in parallel across the hashing pool) or
+    a password_hash produced by a supported algorithm. Every batch is
+    validated with the registration rules, checked for duplicates with
+    one query, inserted with one multi-row statement and committed;
+    then the checkpoint moves past it. If a concurrent registration
+    takes a username or email in between, the batch is retried row by
+    row and only the conflicting records are rejected. Re-running with
+    the same checkpoint resumes after the last committed batch, and records
+    committed before an interruption are rejected as duplicates rather
+    than inserted twice.
+
+    on_reject(line, record, reason) and on_progress(totals) are optional
+    callbacks. Returns the totals: imported, skipped, seconds and rows
+    per second.
+    '''
+    checkpoint = checkpoint or Checkpoint(None, None)
+    totals = dict(checkpoint.totals)
+    started = time.perf_counter()
+
+    def reject(line_number, record, reason):
+        totals['skipped'] += 1
+        if on_reject is not None:
+            on_reject(line_number, record, reason)
+
+    batch = []
+    last_line = checkpoint.line
+    for line_number, record in records:
+        if line_number <= checkpoint.line:
+            continue
+        batch.append((line_number, record))
+        last_line = line_number
+        if len(batch) >= batch_size:
+            totals['imported'] += _import_batch(batch, reject)
+            checkpoint.save(last_line, totals)
+            batch = []
+            if on_progress is not None:
+                on_progress(totals)
+    if batch:
+        totals['imported'] += _import_batch(batch, reject)
+        checkpoint.save(last_line, totals)
+        if on_progress is not None:
+            on_progress(totals)
+
+    elapsed = time.perf_counter() - started
+    return {
+        **totals,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(
+            (totals['imported'] + totals['skipped']) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def export_users(stream, fmt, with_hashes=False, batch_size=1000):
+    '''Write every user to stream as CSV or JSONL without loading them all; return the count'''
+    fields = EXPORT_FIELDS + (('password_hash',) if with_hashes else ())
+    columns = [getattr(User, field) for field in fields]
+    # In primary key order, which the database reads from its index without
+    # sorting. A bulk read that tolerates lag, so it runs on the replica if any
+    result = read_only(
+        select(*columns).order_by(User.id)
+        .execution_options(yield_per=batch_size))
+    writer = csv.writer(stream) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(fields)
+    count = 0
+    for row in result:
+        values = [value.isoformat() if isinstance(value, datetime) else value for value in row]
+        if writer is not None:
+            writer.writerow(values)
+        else:
+            stream.write(json.dumps(dict(zip(fields, values))) + '\n')
+        count += 1
+    return count
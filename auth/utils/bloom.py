@@ -0,0 +1,37 @@
+'''Bloom filter for cheap "definitely not present" membership checks'''
+import hashlib
+import math
+
+
+class BloomFilter:
+    '''Fixed-size bloom filter over strings.
+
+    Sized for capacity items at the given false-positive rate; adding
+    more items than that raises the false-positive rate but never
+    produces false negatives.
+    '''
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Kirsch-Mitzenmacher: derive every index from two 64-bit hashes
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + index * second) % self.size for index in range(self.hash_count))
+
+    def add(self, item):
+        '''Add an item to the filter'''
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
@@ -0,0 +1,46 @@
+'''Database engine helpers: SQLite pragmas and read-replica routing'''
+from sqlalchemy import event
+from auth import db
+
+REPLICA_BIND_KEY = 'replica'
+
+
+def configure_sqlite(engine, journal_mode=None, synchronous=None):
+    '''Set journal_mode/synchronous pragmas on every new SQLite connection'''
+    if engine.dialect.name != 'sqlite' or not (journal_mode or synchronous):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+        cursor = dbapi_connection.cursor()
+        if journal_mode:
+            cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+        if synchronous:
+            cursor.execute(f'PRAGMA synchronous={synchronous}')
+        cursor.close()
+
+
+def init_engines(app):
+    '''Apply per-engine settings to every configured engine'''
+    with app.app_context():
+        for engine in db.engines.values():
+            configure_sqlite(
+                engine,
+                app.config.get('SQLITE_JOURNAL_MODE'),
+                app.config.get('SQLITE_SYNCHRONOUS'),
+            )
+
+
+def read_engine():
+    '''Engine for read-only queries: the replica if one is bound, else the primary.
+
+    Replicas lag behind the primary, so only use this for lookups that
+    tolerate slightly stale data: never for credential or token checks,
+    nor for checks that guard a write.
+    '''
+    return db.engines.get(REPLICA_BIND_KEY, db.engine)
+
+
+def read_only(statement):
+    '''Execute a select on the read engine within the current session'''
+    return db.session.execute(statement, bind_arguments={'bind': read_engine()})
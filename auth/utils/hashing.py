@@ -0,0 +1,394 @@
+'''Password hashing engine that keeps KDF work off the request thread'''
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import bcrypt as bcrypt_lib
+from werkzeug.security import generate_password_hash, check_password_hash
+from auth.utils.metrics import PASSWORD_HASH_DURATION
+
+try:
+    from argon2 import PasswordHasher as Argon2PasswordHasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError:  # argon2-cffi is optional
+    Argon2PasswordHasher = None
+
+
+def _b64encode(data):
+    '''PHC-style base64: standard alphabet without padding'''
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(data):
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def _parse_params(params):
+    '''Parse a PHC parameter segment such as "ln=15,r=8,p=1"'''
+    return {key: int(value) for key, value in (item.split('=') for item in params.split(','))}
+
+
+class Hasher:
+    '''Base class for a password hashing algorithm.
+
+    Every stored hash carries its algorithm and cost parameters, so
+    identify() can pick the hasher for an existing hash and
+    needs_rehash() can tell whether it was made with outdated settings.
+    '''
+    name = None
+    prefixes = ()
+
+    @classmethod
+    def from_config(cls, config):
+        '''Build the hasher from the app config'''
+        raise NotImplementedError
+
+    def identify(self, password_hash):
+        '''Return True if the hash was produced by this algorithm'''
+        return password_hash.startswith(self.prefixes)
+
+    def hash(self, password):
+        '''Return an encoded hash of the password'''
+        raise NotImplementedError
+
+    def verify(self, password_hash, password):
+        '''Check a password against a hash produced by this algorithm'''
+        raise NotImplementedError
+
+    def needs_rehash(self, password_hash):
+        '''Return True if the hash was made with different parameters'''
+        raise NotImplementedError
+
+
+HASHERS = {}
+
+
+def register_hasher(cls):
+    '''Class decorator adding a Hasher to the registry under its name'''
+    HASHERS[cls.name] = cls
+    return cls
+
+
+@register_hasher
+class BcryptHasher(Hasher):
+    '''bcrypt, stored as $2b$<rounds>$<salt+hash>'''
+    name = 'bcrypt'
+    prefixes = ('$2a$', '$2b$', '$2y$')
+
+    def __init__(self, rounds=12):
+        self.rounds = rounds
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(rounds=config.get('PASSWORD_BCRYPT_ROUNDS', 12))
+
+    @staticmethod
+    def _encode(password):
+        # bcrypt only looks at the first 72 bytes
+        return password.encode('utf-8')[:72]
+
+    def hash(self, password):
+        salt = bcrypt_lib.gensalt(rounds=self.rounds)
+        return bcrypt_lib.hashpw(self._encode(password), salt).decode('ascii')
+
+    def verify(self, password_hash, password):
+        try:
+            return bcrypt_lib.checkpw(self._encode(password), password_hash.encode('ascii'))
+        except ValueError:
+            return False
+
+    def needs_rehash(self, password_hash):
+        return int(password_hash.split('$')[2]) != self.rounds
+
+
+@register_hasher
+class ScryptHasher(Hasher):
+    '''scrypt, stored as the PHC string $scrypt$ln=<log2 N>,r=<r>,p=<p>$<salt>$<hash>'''
+    name = 'scrypt'
+    prefixes = ('$scrypt$',)
+
+    def __init__(self, log_n=15, r=8, p=1, salt_length=16, key_length=32):  # pylint: disable=too-many-arguments
+        self.log_n = log_n
+        self.r = r
+        self.p = p
+        self.salt_length = salt_length
+        self.key_length = key_length
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            log_n=config.get('PASSWORD_SCRYPT_LOG_N', 15),
+            r=config.get('PASSWORD_SCRYPT_R', 8),
+            p=config.get('PASSWORD_SCRYPT_P', 1),
+            salt_length=config.get('PASSWORD_SALT_LENGTH', 16),
+        )
+
+    @staticmethod
+    def _derive(password, salt, log_n, r, p, key_length):  # pylint: disable=too-many-arguments
+        n = 1 << log_n
+        return hashlib.scrypt(
+            password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+            maxmem=256 * n * r + 1024 * 1024, dklen=key_length)
+
+    def hash(self, password):
+        salt = os.urandom(self.salt_length)
+        key = self._derive(password, salt, self.log_n, self.r, self.p, self.key_length)
+        return (f"$scrypt$ln={self.log_n},r={self.r},p={self.p}"
+                f"${_b64encode(salt)}${_b64encode(key)}")
+
+    def verify(self, password_hash, password):
+        try:
+            _, _, params, salt, key = password_hash.split('$')
+            params = _parse_params(params)
+            salt, key = _b64decode(salt), _b64decode(key)
+            derived = self._derive(
+                password, salt, params['ln'], params['r'], params['p'], len(key))
+        except (KeyError, ValueError):
+            return False
+        return hmac.compare_digest(derived, key)
+
+    def needs_rehash(self, password_hash):
+        params = _parse_params(password_hash.split('$')[2])
+        return (params['ln'], params['r'], params['p']) != (self.log_n, self.r, self.p)
+
+
+@register_hasher
+class Argon2Hasher(Hasher):
+    '''argon2id via argon2-cffi, stored as $argon2id$v=19$m=<kib>,t=<t>,p=<p>$<salt>$<hash>'''
+    name = 'argon2'
+    prefixes = ('$argon2',)
+
+    def __init__(self, time_cost=3, memory_cost=65536, parallelism=4):
+        if Argon2PasswordHasher is None:
+            raise RuntimeError("argon2 password hashing requires the argon2-cffi package")
+        self.time_cost = time_cost
+        self.memory_cost = memory_cost
+        self.parallelism = parallelism
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            time_cost=config.get('PASSWORD_ARGON2_TIME_COST', 3),
+            memory_cost=config.get('PASSWORD_ARGON2_MEMORY_COST', 65536),
+            parallelism=config.get('PASSWORD_ARGON2_PARALLELISM', 4),
+        )
+
+    def _hasher(self):
+        return Argon2PasswordHasher(
+            time_cost=self.time_cost, memory_cost=self.memory_cost, parallelism=self.parallelism)
+
+    def hash(self, password):
+        return self._hasher().hash(password)
+
+    def verify(self, password_hash, password):
+        try:
+            return self._hasher().verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def needs_rehash(self, password_hash):
+        return self._hasher().check_needs_rehash(password_hash)
+
+
+@register_hasher
+class WerkzeugHasher(Hasher):
+    '''werkzeug.security hashes, stored as <method>:<params>$<salt>$<hash>'''
+    name = 'werkzeug'
+    prefixes = ('scrypt:', 'pbkdf2:')
+
+    def __init__(self, method='scrypt:32768:8:1', salt_length=16):
+        self.method = method
+        self.salt_length = salt_length
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            method=config.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+            salt_length=config.get('PASSWORD_SALT_LENGTH', 16),
+        )
+
+    def hash(self, password):
+        return generate_password_hash(password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return check_password_hash(password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+
+class HasherBusyError(Exception):
+    '''Raised when the hashing engine has no room for more work'''
+
+    def __init__(self, retry_after):
+        super().__init__('Password hashing capacity exhausted')
+        self.retry_after = retry_after
+
+
+class PasswordHashingEngine:
+    '''Runs password hashing and verification on a bounded worker pool.
+
+    New hashes use the PASSWORD_HASH_ALGORITHM hasher from the registry;
+    existing hashes are verified with whichever registered hasher
+    produced them.
+
+    At most PASSWORD_HASH_WORKERS hashes (default 2, 0 for one per CPU)
+    run at once in each process and at most PASSWORD_HASH_MAX_PENDING
+    more may wait for a worker. Anything past that raises
+    HasherBusyError, which the error handlers turn into a 503 with a
+    Retry-After header.
+
+    Backends:
+        process - ProcessPoolExecutor, scales hashing across cores
+        thread  - ThreadPoolExecutor, for KDFs that release the GIL
+        inline  - hash on the calling thread (tests, CLI scripts)
+    '''
+    BACKENDS = ('process', 'thread', 'inline')
+
+    def __init__(self, app=None):
+        self.hasher = ScryptHasher()
+        self.hashers = [self.hasher]
+        self.backend = 'inline'
+        self.workers = 2
+        self.max_pending = 0
+        self.timeout = None
+        self.retry_after = 1
+        self.max_password_bytes = None
+        self._slots = None
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''Read the PASSWORD_HASH_* settings from the app config'''
+        algorithm = app.config.get('PASSWORD_HASH_ALGORITHM', 'scrypt')
+        if algorithm not in HASHERS:
+            raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+        self.hasher = HASHERS[algorithm].from_config(app.config)
+        self.hashers = [self.hasher]
+        for name, cls in HASHERS.items():
+            if name == algorithm:
+                continue
+            try:
+                self.hashers.append(cls.from_config(app.config))
+            except RuntimeError:
+                # Optional dependency missing; hashes of this kind can't be verified
+                continue
+        self.backend = app.config.get('PASSWORD_HASH_BACKEND', self.backend)
+        if self.backend not in self.BACKENDS:
+            raise ValueError(f"Unknown password hash backend: {self.backend}")
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers) or os.cpu_count() or 1
+        self.max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING', self.max_pending)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self.retry_after = app.config.get('PASSWORD_HASH_RETRY_AFTER', self.retry_after)
+        self.max_password_bytes = app.config.get('PASSWORD_MAX_BYTES', self.max_password_bytes)
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+        self.shutdown()
+        app.extensions['password_hasher'] = self
+
+    def identify(self, password_hash):
+        '''Return the registered hasher that produced the hash, or None'''
+        for hasher in self.hashers:
+            if hasher.identify(password_hash):
+                return hasher
+        return None
+
+    def too_long(self, password):
+        '''Whether the password exceeds PASSWORD_MAX_BYTES'''
+        return bool(self.max_password_bytes) and (
+            len(password.encode('utf-8')) > self.max_password_bytes)
+
+    def hash(self, password):
+        '''Return a salted hash of the password with the current algorithm'''
+        if self.too_long(password):
+            raise ValueError('Password exceeds PASSWORD_MAX_BYTES')
+        return self._timed('hash', self.hasher, self.hasher.hash, password)
+
+    def hash_many(self, passwords):
+        '''Hash a batch of passwords across the whole worker pool.
+
+        Meant for bulk jobs such as user imports: it bypasses the
+        per-request backpressure and waits for every hash.
+        '''
+        if any(self.too_long(password) for password in passwords):
+            raise ValueError('Password exceeds PASSWORD_MAX_BYTES')
+        if self.backend == 'inline' or len(passwords) < 2:
+            return [self.hasher.hash(password) for password in passwords]
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        return list(self._get_executor().map(self.hasher.hash, passwords, chunksize=chunksize))
+
+    def verify(self, password_hash, password):
+        '''Check a password against a stored hash'''
+        hasher = self.identify(password_hash or '')
+        if hasher is None or self.too_long(password):
+            return False
+        return self._timed('verify', hasher, hasher.verify, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        '''Return True if the hash uses another algorithm or outdated cost'''
+        if not self.hasher.identify(password_hash):
+            return True
+        try:
+            return self.hasher.needs_rehash(password_hash)
+        except (IndexError, KeyError, ValueError):
+            return True
+
+    def shutdown(self):
+        '''Stop the worker pool, if one has been started'''
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._executor_pid = None
+
+    def _get_executor(self):
+        '''Create the pool lazily so each forked gunicorn worker gets its own'''
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                if self.backend == 'process':
+                    # Lives as long as the process; shutdown() stops it
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix='password-hasher')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _timed(self, operation, hasher, func, *args):
+        started = time.perf_counter()
+        try:
+            return self._run(func, *args)
+        finally:
+            PASSWORD_HASH_DURATION.observe(
+                time.perf_counter() - started, operation=operation, algorithm=hasher.name)
+
+    def _run(self, func, *args):
+        slots = self._slots
+        if slots is None:
+            return func(*args)
+        # Released below once the hash finishes, which may be after this returns
+        if not slots.acquire(blocking=False):  # pylint: disable=consider-using-with
+            raise HasherBusyError(self.retry_after)
+        if self.backend == 'inline':
+            try:
+                return func(*args)
+            finally:
+                slots.release()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            slots.release()
+            raise
+        # A hash that outlives its timeout keeps its slot until it finishes
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError as e:
+            future.cancel()
+            raise HasherBusyError(self.retry_after) from e
@@ -0,0 +1,91 @@
+'''Request-scoped JWT identity: verify the token at most once per request'''
+from functools import wraps
+from flask import current_app, g, request
+from flask_jwt_extended import get_jwt, verify_jwt_in_request
+from flask_jwt_extended.exceptions import (
+    JWTExtendedException, NoAuthorizationError, WrongTokenError
+)
+from jwt.exceptions import PyJWTError
+from auth.utils.token_cache import VerifiedTokenCache
+
+# Shared with auth.__init__, which calls init_app on it
+token_cache = VerifiedTokenCache()
+
+
+def resolve_jwt():
+    '''Decode and verify the request's JWT once, caching the outcome on g.
+
+    Returns (claims, error): claims is None when there is no token or it
+    is invalid, in which case error holds the verification exception.
+    Access tokens seen before are served from token_cache without
+    verifying the signature again.
+    The token type is not checked here so the same result serves access
+    and refresh routes; auth_required() enforces the type.
+    '''
+    if 'resolved_jwt' not in g:
+        claims, error = None, None
+        token = _raw_token()
+        if token:
+            claims = token_cache.get(token)
+            if claims is not None and _is_revoked(claims):
+                # Re-verify so the blocklist check raises RevokedTokenError
+                claims = None
+            if claims is None:
+                try:
+                    verify_jwt_in_request(optional=True, verify_type=False)
+                    claims = get_jwt() or None
+                except (JWTExtendedException, PyJWTError) as e:
+                    error = e
+                if claims:
+                    token_cache.put(token, claims)
+        g.resolved_jwt = (claims, error)
+    return g.resolved_jwt
+
+
+def _is_revoked(claims):
+    revocation = current_app.extensions.get('revocation')
+    return revocation is not None and revocation.is_revoked(claims)
+
+
+def _raw_token():
+    '''The encoded JWT from the Authorization header, or None'''
+    value = request.headers.get(current_app.config.get('JWT_HEADER_NAME', 'Authorization'))
+    if not value:
+        return None
+    header_type = current_app.config.get('JWT_HEADER_TYPE', 'Bearer')
+    if header_type and value.startswith(f"{header_type} "):
+        return value[len(header_type) + 1:]
+    return value
+
+
+def current_claims():
+    '''Claims of a valid token on the request, or an empty dict'''
+    claims, _ = resolve_jwt()
+    return claims or {}
+
+
+def current_identity():
+    '''Identity of a valid token on the request, or None'''
+    return current_claims().get(current_app.config.get('JWT_IDENTITY_CLAIM', 'sub'))
+
+
+def auth_required(refresh=False):
+    '''Replacement for jwt_required() that shares the request's single verification'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method in current_app.config.get('JWT_EXEMPT_METHODS', ['OPTIONS']):
+                return func(*args, **kwargs)
+            claims, error = resolve_jwt()
+            if error is not None:
+                raise error
+            if claims is None:
+                header = current_app.config.get('JWT_HEADER_NAME', 'Authorization')
+                raise NoAuthorizationError(f"Missing {header} Header")
+            if refresh and claims.get('type') != 'refresh':
+                raise WrongTokenError("Only refresh tokens are allowed")
+            if not refresh and claims.get('type') == 'refresh':
+                raise WrongTokenError("Only non-refresh tokens are allowed")
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
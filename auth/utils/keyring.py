@@ -0,0 +1,254 @@
+'''Asymmetric JWT signing keys selected by kid, with scheduled rotation'''
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from jwt.exceptions import InvalidTokenError
+
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+    from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+except ImportError:  # cryptography is only needed for asymmetric signing
+    serialization = None
+
+RSA_ALGORITHMS = ('RS256', 'RS384', 'RS512')
+ASYMMETRIC_ALGORITHMS = RSA_ALGORITHMS + ('EdDSA',)
+
+
+class SigningKey:
+    '''A private key with its kid, algorithm and activation time.
+
+    Keys are stored as <kid>.pem. Generated keys get a kid of the form
+    <activates_at>-<random>; any other file name activates immediately.
+    '''
+
+    def __init__(self, kid, algorithm, private_key, activates_at=0):
+        self.kid = kid
+        self.algorithm = algorithm
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+        self.activates_at = activates_at
+
+    @classmethod
+    def generate(cls, algorithm, activates_at, rsa_key_size=2048):
+        '''Create a new key for algorithm that becomes the signing key at activates_at'''
+        if algorithm == 'EdDSA':
+            private_key = ed25519.Ed25519PrivateKey.generate()
+        else:
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=rsa_key_size)
+        kid = f"{int(activates_at)}-{secrets.token_hex(4)}"
+        return cls(kid, algorithm, private_key, int(activates_at))
+
+    @classmethod
+    def load(cls, path, algorithm):
+        '''Load a PEM private key file, or return None if it doesn't fit algorithm'''
+        with open(path, 'rb') as key_file:
+            private_key = serialization.load_pem_private_key(key_file.read(), password=None)
+        if algorithm == 'EdDSA' and not isinstance(private_key, ed25519.Ed25519PrivateKey):
+            return None
+        if algorithm in RSA_ALGORITHMS and not isinstance(private_key, rsa.RSAPrivateKey):
+            return None
+        kid = os.path.splitext(os.path.basename(path))[0]
+        prefix = kid.split('-', 1)[0]
+        return cls(kid, algorithm, private_key, int(prefix) if prefix.isdigit() else 0)
+
+    def save(self, key_dir):
+        '''Write the key as <kid>.pem, readable by the owner only'''
+        pem = self.private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+        path = os.path.join(key_dir, f"{self.kid}.pem")
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, 'wb') as key_file:
+            key_file.write(pem)
+        return path
+
+    def jwk(self):
+        '''The public half as a JWK'''
+        if self.algorithm == 'EdDSA':
+            jwk = OKPAlgorithm.to_jwk(self.public_key, as_dict=True)
+        else:
+            jwk = RSAAlgorithm.to_jwk(self.public_key, as_dict=True)
+        jwk.update({'kid': self.kid, 'alg': self.algorithm, 'use': 'sig'})
+        return jwk
+
+
+class KeyRing:
+    '''Signs tokens with the current key and verifies them with any published key.
+
+    The keys live in JWT_KEY_DIR, shared by every worker. A key is
+    published in the JWKS as soon as it exists, becomes the signing key
+    at its activation time and, once a newer key has taken over, stays
+    published for JWT_KEY_RETENTION seconds so tokens it signed can
+    still be verified. rotate() schedules the next key
+    JWT_KEY_PUBLISH_AHEAD seconds before it activates, which must be
+    longer than the JWKS max-age so resource servers see it before it is
+    used, and deletes retired keys. Workers reload the directory every
+    JWT_KEY_RELOAD_INTERVAL seconds, or sooner when they see an unknown
+    kid.
+
+    With a symmetric JWT_ALGORITHM (the default HS256) the ring is
+    disabled and flask_jwt_extended signs with JWT_SECRET_KEY as before.
+    '''
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.algorithm = 'HS256'
+        self.key_dir = 'instance/jwt_keys'
+        self.rotation_interval = 30 * 24 * 3600
+        self.publish_ahead = 3600
+        self.retention = 7200
+        self.reload_interval = 60
+        self.auto_rotate = True
+        self.rsa_key_size = 2048
+        self.jwks_max_age = 300
+        self._keys = []
+        self._by_kid = {}
+        self._jwks = None
+        self._next_reload = 0
+        self._next_forced_reload = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''Read the JWT_KEY_* settings and load the keys'''
+        self.algorithm = app.config.get('JWT_ALGORITHM', self.algorithm)
+        self.enabled = self.algorithm in ASYMMETRIC_ALGORITHMS
+        self.key_dir = app.config.get('JWT_KEY_DIR', self.key_dir)
+        self.rotation_interval = app.config.get('JWT_KEY_ROTATION_INTERVAL', self.rotation_interval)
+        self.publish_ahead = app.config.get('JWT_KEY_PUBLISH_AHEAD', self.publish_ahead)
+        self.retention = app.config.get('JWT_KEY_RETENTION', self.retention)
+        self.reload_interval = app.config.get('JWT_KEY_RELOAD_INTERVAL', self.reload_interval)
+        self.auto_rotate = app.config.get('JWT_KEY_AUTO_ROTATE', self.auto_rotate)
+        self.rsa_key_size = app.config.get('JWT_RSA_KEY_SIZE', self.rsa_key_size)
+        self.jwks_max_age = app.config.get('JWKS_MAX_AGE', self.jwks_max_age)
+        app.extensions['key_ring'] = self
+        if not self.enabled:
+            return
+        if serialization is None:
+            raise RuntimeError(
+                f"{self.algorithm} token signing requires the cryptography package")
+        app.config['JWT_DECODE_ALGORITHMS'] = [self.algorithm]
+        os.makedirs(self.key_dir, mode=0o700, exist_ok=True)
+        self.reload()
+        if self.auto_rotate:
+            self.rotate()
+        if self.signing_key() is None:
+            raise RuntimeError(f"No active JWT signing key in {self.key_dir}")
+
+    def reload(self):
+        '''Read the key directory again'''
+        keys = []
+        for name in sorted(os.listdir(self.key_dir)):
+            if not name.endswith('.pem'):
+                continue
+            try:
+                key = SigningKey.load(os.path.join(self.key_dir, name), self.algorithm)
+            except FileNotFoundError:  # retired by another worker meanwhile
+                continue
+            if key is not None:
+                keys.append(key)
+        keys.sort(key=lambda key: (key.activates_at, key.kid))
+        with self._lock:
+            if [key.kid for key in keys] != [key.kid for key in self._keys]:
+                self._jwks = None
+            self._keys = keys
+            self._by_kid = {key.kid: key for key in keys}
+            self._next_reload = time.monotonic() + self.reload_interval
+
+    def _reload_if_due(self):
+        if time.monotonic() >= self._next_reload:
+            if self.auto_rotate:
+                self.rotate()
+            else:
+                self.reload()
+
+    def signing_key(self, now=None):
+        '''The newest key that has activated'''
+        now = time.time() if now is None else now
+        active = [key for key in self._keys if key.activates_at <= now]
+        return active[-1] if active else None
+
+    def rotate(self, now=None):
+        '''Schedule the next key when due and delete retired keys.
+
+        Returns (created, deleted) lists of kids. Safe to run from
+        several workers or from cron at once: the worst case is an
+        extra scheduled key.
+        '''
+        now = time.time() if now is None else now
+        self.reload()
+        created, deleted = [], []
+        current = self.signing_key(now)
+        upcoming = [key for key in self._keys if key.activates_at > now]
+        if current is None and not upcoming:
+            created.append(self._create(now))
+        elif current is not None and not upcoming and self.rotation_interval:
+            due = current.activates_at + self.rotation_interval
+            if now >= due - self.publish_ahead:
+                created.append(self._create(max(due, now + self.publish_ahead)))
+        for key, successor in zip(self._keys, self._keys[1:]):
+            if successor.activates_at <= now - self.retention:
+                try:
+                    os.remove(os.path.join(self.key_dir, f"{key.kid}.pem"))
+                except FileNotFoundError:
+                    continue
+                deleted.append(key.kid)
+        if created or deleted:
+            self.reload()
+        return created, deleted
+
+    def _create(self, activates_at):
+        key = SigningKey.generate(self.algorithm, activates_at, self.rsa_key_size)
+        key.save(self.key_dir)
+        return key.kid
+
+    # flask_jwt_extended callbacks. It asks for the headers before the
+    # key, so the key picked for the kid header is pinned to the thread
+    # until the key is requested, even if a rotation happens in between.
+
+    def signing_headers(self, identity):  # pylint: disable=unused-argument
+        '''additional_headers_loader: name the signing key'''
+        self._reload_if_due()
+        key = self.signing_key()
+        self._local.key = key
+        return {'kid': key.kid}
+
+    def encode_key(self, identity):  # pylint: disable=unused-argument
+        '''encode_key_loader: the key named by signing_headers()'''
+        key = getattr(self._local, 'key', None) or self.signing_key()
+        self._local.key = None
+        return key.private_key
+
+    def decode_key(self, jwt_header, jwt_payload):  # pylint: disable=unused-argument
+        '''decode_key_loader: the public key for the token's kid'''
+        self._reload_if_due()
+        kid = jwt_header.get('kid')
+        key = self._by_kid.get(kid)
+        if key is None and kid and time.monotonic() >= self._next_forced_reload:
+            # Another worker may have just scheduled it; made-up kids can
+            # trigger this at most once a second
+            self._next_forced_reload = time.monotonic() + 1
+            self.reload()
+            key = self._by_kid.get(kid)
+        if key is None:
+            raise InvalidTokenError("Unknown signing key")
+        return key.public_key
+
+    def jwks(self):
+        '''The published keys as a JSON Web Key Set: (body, etag)'''
+        if self.enabled:
+            self._reload_if_due()
+        with self._lock:
+            if self._jwks is None:
+                keys = [key.jwk() for key in self._keys] if self.enabled else []
+                body = json.dumps({'keys': keys}, sort_keys=True, separators=(',', ':'))
+                self._jwks = (body, hashlib.sha256(body.encode('utf-8')).hexdigest()[:32])
+            return self._jwks
@@ -0,0 +1,207 @@
+'''Read windows of the rotating application log without loading whole files'''
+import gzip
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+LINE_PATTERN = re.compile(
+    r'^(?P<time>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+ - (?P<logger>\S+) - '
+    r'(?P<level>[A-Z]+) - (?P<message>.*)$'
+)
+USER_ID_PATTERN = re.compile(r'User ID: (?P<user_id>\S+) - ')
+CHUNK_SIZE = 8192
+
+
+def rotated_path(path, index):
+    '''Path of backup number index (0 is the live file), compressed or not'''
+    if index == 0:
+        return path
+    plain = f"{path}.{index}"
+    return plain if os.path.exists(plain) or not os.path.exists(f"{plain}.gz") else f"{plain}.gz"
+
+
+def log_files(path, backup_count):
+    '''Existing log files, newest first: app.log, app.log.1, ... app.log.N'''
+    candidates = [rotated_path(path, index) for index in range(backup_count + 1)]
+    return [candidate for candidate in candidates if os.path.exists(candidate)]
+
+
+def _open(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')  # pylint: disable=consider-using-with
+
+
+def parse_line(line):
+    '''Split a JSON or text log line into its fields, or None if it isn't a record'''
+    if line.startswith('{'):
+        try:
+            fields = json.loads(line)
+            fields['logged_at'] = datetime.fromisoformat(fields['time']).replace(tzinfo=None)
+        except (ValueError, KeyError):
+            return None
+        return fields
+    match = LINE_PATTERN.match(line)
+    if not match:
+        return None
+    fields = match.groupdict()
+    fields['logged_at'] = datetime.strptime(fields['time'], '%Y-%m-%d %H:%M:%S')
+    fields['function'] = fields['message'].split(' - ', 1)[0]
+    user = USER_ID_PATTERN.search(fields['message'])
+    fields['user_id'] = user.group('user_id') if user else None
+    return fields
+
+
+class LogFilter:  # pylint: disable=too-few-public-methods
+    '''Matches log lines against level, function, user and time range filters'''
+
+    def __init__(self, level=None, function=None, user_id=None, since=None, until=None):  # pylint: disable=too-many-arguments
+        self.min_level = logging.getLevelName(level.upper()) if level else None
+        if self.min_level is not None and not isinstance(self.min_level, int):
+            raise ValueError(f"Unknown log level: {level}")
+        self.function = function
+        self.user_id = user_id
+        self.since = self._parse_time(since)
+        self.until = self._parse_time(until)
+
+    @staticmethod
+    def _parse_time(value):
+        '''Parse an ISO time; aware times are converted to naive UTC like the JSON logs'''
+        if not value:
+            return None
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+
+    @property
+    def active(self):
+        '''True if any filter is set'''
+        return any(value is not None for value in (
+            self.min_level, self.function, self.user_id, self.since, self.until))
+
+    def matches(self, line):
+        '''Return True if the line passes every filter'''
+        if not self.active:
+            return True
+        fields = parse_line(line)
+        if fields is None:
+            return False
+        if self.min_level is not None and \
+                logging.getLevelName(fields['level']) < self.min_level:
+            return False
+        if self.function is not None and fields.get('function') != self.function:
+            return False
+        if self.user_id is not None and fields.get('user_id') != self.user_id:
+            return False
+        if self.since and fields['logged_at'] < self.since:
+            return False
+        if self.until and fields['logged_at'] > self.until:
+            return False
+        return True
+
+
+def _reverse_lines(path):
+    '''Yield the lines of a file from last to first, reading fixed-size chunks from the end'''
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        remainder = b''
+        while position > 0:
+            size = min(CHUNK_SIZE, position)
+            position -= size
+            file.seek(position)
+            lines = (file.read(size) + remainder).split(b'\n')
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode('utf-8', 'replace')
+        if remainder:
+            yield remainder.decode('utf-8', 'replace')
+
+
+def _tail_compressed(path, count, log_filter):
+    '''Last count matching lines of a gzipped file, newest first.
+
+    gzip can't be read backwards, so scan forward keeping a bounded window.
+    '''
+    window = deque(maxlen=count)
+    with gzip.open(path, 'rb') as file:
+        for raw in file:
+            line = raw.decode('utf-8', 'replace').rstrip('\n')
+            if line and log_filter.matches(line):
+                window.append(line)
+    return reversed(window)
+
+
+def tail(files, count, log_filter):
+    '''Last count matching lines across the rotated files, oldest first.
+
+    Older backups are only opened once the newer ones are exhausted.
+    '''
+    if count <= 0:
+        return []
+    lines = []
+    for path in files:
+        if path.endswith('.gz'):
+            lines.extend(_tail_compressed(path, count - len(lines), log_filter))
+            if len(lines) == count:
+                break
+            continue
+        for line in _reverse_lines(path):
+            if log_filter.matches(line):
+                lines.append(line)
+                if len(lines) == count:
+                    return lines[::-1]
+    return lines[::-1]
+
+
+def read_page(path, offset, limit, log_filter):
+    '''Up to limit matching lines starting at byte offset.
+
+    Returns (lines, next_offset); pass next_offset back to continue.
+    '''
+    lines = []
+    with _open(path) as file:
+        file.seek(offset)
+        while len(lines) < limit:
+            raw = file.readline()
+            if not raw:
+                break
+            line = raw.decode('utf-8', 'replace').rstrip('\n')
+            if log_filter.matches(line):
+                lines.append(line)
+        return lines, file.tell()
+
+
+def follow(path, offset, log_filter, max_seconds, poll_interval=1.0):
+    '''Yield server-sent events for lines appended to path after offset.
+
+    Reopens the file from the start when it is rotated, and stops after
+    max_seconds so a follower can't hold a worker forever.
+    '''
+    deadline = time.monotonic() + max_seconds
+    position = offset
+    while time.monotonic() < deadline:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if size < position:
+            position = 0
+        if size > position:
+            with open(path, 'rb') as file:
+                file.seek(position)
+                for raw in file:
+                    if not raw.endswith(b'\n'):
+                        break
+                    position += len(raw)
+                    line = raw.decode('utf-8', 'replace').rstrip('\n')
+                    if log_filter.matches(line):
+                        yield f"id: {position}\ndata: {line}\n\n"
+        else:
+            # Comment line keeps proxies from closing an idle stream
+            yield ': keep-alive\n\n'
+        time.sleep(poll_interval)
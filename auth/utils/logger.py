@@ -1,89 +1,425 @@
+import atexit
+import gzip
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from functools import wraps
 from logging import Handler
-from flask import jsonify, request
-from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
-from flask_jwt_extended.exceptions import NoAuthorizationError, WrongTokenError
-import requests
+from uuid import uuid4
+from flask import g, jsonify, request
 from dotenv import load_dotenv
+from auth.utils.identity import current_identity
+from auth.utils.metrics import SLACK_LOG_RECORDS
 
 load_dotenv(".env")
-# Ensure the logs directory exists
-if not os.path.exists('logs'):
-    os.makedirs('logs')
+LOG_FILE_PATH = 'logs/app.log'
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '10'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats a record as one JSON object per line'''
+    FIELDS = ('request_id', 'method', 'route', 'status', 'latency_ms', 'user_id', 'ip')
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc)
+                    .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': getattr(record, 'function', None),
+            'message': getattr(record, 'log_message', None) or record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _gzip_rotator(source, dest):
+    '''Compress a rotated log file'''
+    with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    '''Rotates when the file reaches max_bytes or every interval seconds.
+
+    With compress=True rotated files are gzipped to app.log.N.gz.
+    '''
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, interval=0, compress=False):  # pylint: disable=too-many-arguments
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+        if compress:
+            self.namer = lambda name: f"{name}.gz"
+            self.rotator = _gzip_rotator
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+# Custom logger. Records only go on a queue in the calling thread;
+# formatting, file I/O and Slack shipping happen on the listener thread.
+# The sinks are built when the first record is logged, so importing this
+# module creates no directories, files or threads. A forked child (e.g. a
+# gunicorn worker with --preload) starts its own sinks, since the parent's
+# listener thread doesn't survive the fork. The queue holds at most
+# LOG_QUEUE_SIZE records; past that new records are dropped.
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+
+class LogSinks:  # pylint: disable=too-few-public-methods
+    '''The handlers of this process and the listener thread feeding them'''
+
+    def __init__(self):
+        self.file_handler = None
+        self.slack_handler = None
+        self.listener = None
+        self.lock = threading.Lock()
+        self.deferred = 0
+
+
+sinks = LogSinks()
+
+
+def build_file_handler():
+    '''Build the rotating file handler from LOG_* environment variables'''
+    os.makedirs(os.path.dirname(LOG_FILE_PATH), exist_ok=True)
+    handler = SizeAndTimeRotatingFileHandler(
+        LOG_FILE_PATH,
+        max_bytes=int(os.getenv('LOG_MAX_BYTES', '100000')),
+        backup_count=LOG_BACKUP_COUNT,
+        interval=int(os.getenv('LOG_ROTATE_INTERVAL', '0')),
+        compress=os.getenv('LOG_COMPRESS', 'false').lower() in ('1', 'true', 'yes'),
+    )
+    handler.setLevel(logging.INFO)
+    if os.getenv('LOG_FORMAT', 'json') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def start_log_sinks():
+    '''Open the log file, connect Slack and start the listener thread once'''
+    if sinks.listener is not None:
+        return sinks.listener
+    with sinks.lock:
+        if sinks.listener is None:
+            sinks.file_handler = build_file_handler()
+            sinks.slack_handler = slack_handler_from_env()
+            sink_handlers = [sinks.file_handler]
+            if sinks.slack_handler is not None:
+                sink_handlers.append(sinks.slack_handler)
+            listener = QueueListener(log_queue, *sink_handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            sinks.listener = listener
+    return sinks.listener
+
+
+@contextmanager
+def deferred_log_sinks():
+    '''Queue records logged inside the block without starting the sinks.
+
+    They are written once the sinks start: on the next record logged
+    after the block, or at exit if none is.
+    '''
+    sinks.deferred += 1
+    try:
+        yield
+    finally:
+        sinks.deferred -= 1
+
+
+def _flush_deferred_records():
+    '''Write records queued at boot by a process that never logged again'''
+    if sinks.listener is None and not log_queue.empty():
+        listener = start_log_sinks()
+        atexit.unregister(listener.stop)
+        listener.stop()
+
+
+atexit.register(_flush_deferred_records)
+
+
+class LazyQueueHandler(QueueHandler):
+    '''Queues records, starting the sinks on the first one.
+
+    Records that don't fit in the queue are dropped and counted.
+    '''
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def emit(self, record):
+        if sinks.listener is None and not sinks.deferred:
+            start_log_sinks()
+        super().emit(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
 
-# Configure logging to file
-file_handler = RotatingFileHandler('logs/app.log', maxBytes=100000, backupCount=10)
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
-# Custom logger
 logger = logging.getLogger('app_logger')
 logger.setLevel(logging.INFO)
-logger.addHandler(file_handler)
+queue_handler = LazyQueueHandler(log_queue)
+logger.addHandler(queue_handler)
+
+
+def _reset_log_sinks_in_child():
+    '''Give a forked child a fresh queue and lock; its first record starts its own sinks'''
+    global log_queue, sinks  # pylint: disable=global-statement
+    if sinks.listener is not None:
+        atexit.unregister(sinks.listener.stop)
+    # Records still queued in the parent are the parent's to write
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler.queue = log_queue
+    sinks = LogSinks()
+
+
+os.register_at_fork(after_in_child=_reset_log_sinks_in_child)
 
 # Custom Slack handler
 class SlackHandler(Handler):
-    def __init__(self, webhook_url):
+    '''Ships log records to a Slack webhook from a background thread.
+
+    Records are put on a bounded in-memory queue by emit() and a single
+    worker thread drains it, joining up to batch_size records into one
+    Slack message. When the queue is full the overflow policy decides
+    what happens: "drop_new" discards the incoming record, "drop_old"
+    evicts the oldest queued record and "block" waits up to
+    block_timeout seconds for room before dropping.
+    '''
+    OVERFLOW_POLICIES = ('drop_new', 'drop_old', 'block')
+
+    def __init__(self, webhook_url, max_queue_size=1000, batch_size=20,  # pylint: disable=too-many-arguments
+                 flush_interval=2.0, timeout=5.0, overflow='drop_new', block_timeout=0.1):
         super().__init__()
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
         self.webhook_url = webhook_url
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        # Only deployments that ship to Slack pay for importing requests
+        import requests  # pylint: disable=import-outside-toplevel
+        from requests.adapters import HTTPAdapter  # pylint: disable=import-outside-toplevel
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._counter_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, name='slack-log-shipper', daemon=True)
+        self._worker.start()
+
+    @property
+    def queued(self):
+        '''Number of records waiting to be shipped'''
+        return self.queue.qsize()
+
+    def stats(self):
+        '''Return the shipping counters'''
+        with self._counter_lock:
+            return {
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'queued': self.queued,
+            }
 
     def emit(self, record):
-        log_entry = self.format(record)
-        payload = {"username": "General Logs", "text": log_entry,}
         try:
-            requests.post(self.webhook_url, json=payload)
-        except Exception as e:
-            print(f"Failed to send log to Slack: {e}")
+            log_entry = self.format(record)
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.handleError(record)
+            return
+        if self.overflow == 'block':
+            try:
+                self.queue.put(log_entry, timeout=self.block_timeout)
+            except queue.Full:
+                self._count('dropped')
+            return
+        try:
+            self.queue.put_nowait(log_entry)
+            return
+        except queue.Full:
+            pass
+        if self.overflow == 'drop_old':
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self._count('dropped')
+            try:
+                self.queue.put_nowait(log_entry)
+                return
+            except queue.Full:
+                pass
+        self._count('dropped')
 
-# Initialize Slack handler
-slack_handler = SlackHandler(os.getenv('SLACK_WEBHOOK'))
-slack_handler.setLevel(logging.INFO)
-slack_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-logger.addHandler(slack_handler)
+    def flush(self):
+        '''Ship everything currently queued from the calling thread'''
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                return
+            self._send(batch)
 
-def log_error(function_name, message):
+    def close(self):
+        self._stop.set()
+        self._worker.join(timeout=self.timeout)
+        self.flush()
+        self.session.close()
+        super().close()
+
+    def _count(self, name, amount=1):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + amount)
+        SLACK_LOG_RECORDS.inc(amount, state=name)
+
+    def _drain(self, block=True):
+        '''Collect up to batch_size queued records'''
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _send(self, batch):
+        payload = {"username": "General Logs", "text": "\n".join(batch)}
+        try:
+            response = self.session.post(self.webhook_url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self._count('failed', len(batch))
+            # Not through the app logger, whose records would come back here
+            sys.stderr.write(f"Failed to send {len(batch)} log records to Slack: {e}\n")
+        else:
+            self._count('sent', len(batch))
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._drain()
+            if batch:
+                self._send(batch)
+
+
+def slack_handler_from_env():
+    '''Build a SlackHandler from SLACK_* environment variables'''
+    webhook_url = os.getenv('SLACK_WEBHOOK')
+    if not webhook_url:
+        return None
+    handler = SlackHandler(
+        webhook_url,
+        max_queue_size=int(os.getenv('SLACK_QUEUE_SIZE', '1000')),
+        batch_size=int(os.getenv('SLACK_BATCH_SIZE', '20')),
+        flush_interval=float(os.getenv('SLACK_FLUSH_INTERVAL', '2.0')),
+        timeout=float(os.getenv('SLACK_TIMEOUT', '5.0')),
+        overflow=os.getenv('SLACK_OVERFLOW', 'drop_new'),
+    )
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    # Records logged with local_only=True stay in the log file
+    handler.addFilter(lambda record: not getattr(record, 'local_only', False))
+    return handler
+
+def _log(level, function_name, message, fields):
+    '''Log "function - message", keeping both and any extra fields on the record'''
+    logger.log(level, "%s - %s", function_name, message,
+               extra={'function': function_name, 'log_message': message, **fields})
+
+def log_error(function_name, message, **fields):
     '''Logs Error'''
-    logger.error("%s - %s", function_name, message)
+    _log(logging.ERROR, function_name, message, fields)
 
-def log_success(function_name, message):
+def log_success(function_name, message, **fields):
     '''Logs Success'''
-    logger.info("%s - %s", function_name, message)
+    _log(logging.INFO, function_name, message, fields)
 
-def log_warning(function_name, message):
+def log_warning(function_name, message, **fields):
     '''Logs Warning'''
-    logger.warning("%s - %s", function_name, message)
+    _log(logging.WARNING, function_name, message, fields)
 
-def log_debug(function_name, message):
+def log_debug(function_name, message, **fields):
     '''Logs Debug'''
-    logger.debug("%s - %s", function_name, message)
+    _log(logging.DEBUG, function_name, message, fields)
+
+def init_request_logging(app):
+    '''Give every request an id and start time, and echo the id back'''
+    @app.before_request
+    def start_request():
+        g.request_id = request.headers.get('X-Request-ID') or uuid4().hex
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def add_request_id(response):
+        if 'request_id' in g:
+            response.headers['X-Request-ID'] = g.request_id
+        return response
 
 def log_route(func):
     '''Logs route requests'''
     @wraps(func)
     def wrapper(*args, **kwargs):
-        try:
-            verify_jwt_in_request()
-            user_id = get_jwt_identity()
-        except NoAuthorizationError:
-            user_id = None
-            logging.debug("No authorization header present")
-        except WrongTokenError:
-            user_id = None
-            logging.debug("Refresh token used where access token expected")
-        except (RuntimeError, ValueError):
-            user_id = None
-            logging.debug("RuntimeError or ValueError occurred")
-
-        response, status = func(*args, **kwargs)
+        # Reuses the verification done by auth_required or the rate limiter
+        user_id = current_identity()
+
+        response, status, *headers = func(*args, **kwargs)
         user_info = f"User ID: {user_id} - " if user_id else ""
         ip_address = request.remote_addr
         message = response.get('message') or response.get('msg') or 'No message provided'
+        started = g.get('request_started')
+        fields = {
+            'request_id': g.get('request_id'),
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule else request.path,
+            'status': status,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 2) if started else None,
+            'user_id': user_id,
+            'ip': ip_address,
+        }
         if 200 <= status < 300:
-            log_success(func.__name__, f"{ip_address} {user_info}{message}")
+            log_success(func.__name__, f"{ip_address} {user_info}{message}", **fields)
         else:
-            log_error(func.__name__, f"{ip_address} {user_info}{message}")
-        return jsonify(response), status
+            log_error(func.__name__, f"{ip_address} {user_info}{message}", **fields)
+        return (jsonify(response), status, *headers)
     return wrapper
@@ -0,0 +1,383 @@
+'''In-process metrics in the Prometheus text format.
+
+Counters, gauges and histograms live in a MetricsRegistry and are
+updated under one lock, so recording a sample costs a dict update.
+
+Under gunicorn every worker has its own registry. With METRICS_DIR set,
+each worker writes a JSON snapshot of its samples to <METRICS_DIR>/<pid>.json
+at most every METRICS_FLUSH_INTERVAL seconds (from after_request, so
+an idle worker writes nothing), and /metrics adds up the snapshots of
+every worker. Counters and histograms of exited workers are kept so
+totals never go backwards; gauges only count live workers. Empty the
+directory before starting the master so old pids aren't counted.
+'''
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''A named family of samples keyed by label values'''
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def merge(self, samples, into):
+        '''Add snapshot samples ([labels, value] pairs) to a {labels: value} dict'''
+        for labels, value in samples:
+            key = tuple(labels)
+            into[key] = into.get(key, 0) + value
+
+    def render(self, samples):
+        '''Exposition lines for {labels: value} samples'''
+        for labels, value in sorted(samples.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Counter(Metric):
+    '''Monotonic count, e.g. responses by status'''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''Add amount to the labelled count'''
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''Current value, read from collect() whenever a snapshot is taken'''
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, labelnames=(), collect=None):  # pylint: disable=too-many-arguments
+        super().__init__(registry, name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        '''Set the labelled value'''
+        if not self.registry.enabled:
+            return
+        with self.registry.lock:
+            self.values[self._key(labels)] = value
+
+    def refresh(self):
+        '''Replace the values with collect()'s {labels dict: value} result'''
+        if self.collect is None:
+            return
+        try:
+            collected = self.collect()
+        except RuntimeError:
+            # Needs an app context; keep the last values
+            return
+        with self.registry.lock:
+            self.values = {self._key(labels): value for labels, value in collected}
+
+
+class Histogram(Metric):
+    '''Distribution of observations in fixed buckets, plus their sum and count'''
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):  # pylint: disable=too-many-arguments
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        '''Record one observation'''
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            # Per-bucket counts, then sum and count
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def merge(self, samples, into):
+        for labels, counts in samples:
+            key = tuple(labels)
+            total = into.get(key)
+            into[key] = counts[:] if total is None else [a + b for a, b in zip(total, counts)]
+
+    def render(self, samples):
+        for labels, counts in sorted(samples.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = (('le', _format_value(bound)),)
+                label_text = _format_labels(self.labelnames, labels, le)
+                yield f'{self.name}_bucket{label_text} {cumulative}'
+            label_text = _format_labels(self.labelnames, labels)
+            yield f'{self.name}_sum{label_text} {_format_value(counts[-2])}'
+            yield f'{self.name}_count{label_text} {counts[-1]}'
+
+
+class MetricsRegistry:
+    '''Holds the metrics of one process and renders those of all workers'''
+
+    def __init__(self):
+        self.enabled = True
+        self.directory = None
+        self.flush_interval = 5
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self._next_flush = 0
+
+    def init_app(self, app):
+        '''Read the METRICS_* settings and record every request'''
+        self.enabled = app.config.get('METRICS_ENABLED', self.enabled)
+        self.directory = app.config.get('METRICS_DIR') or None
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', self.flush_interval)
+        app.extensions['metrics'] = self
+        if not self.enabled:
+            return
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            atexit.register(self.flush)
+        _listen_for_queries()
+        app.before_request(_start_request)
+        app.after_request(self._finish_request)
+
+    def counter(self, name, documentation, labelnames=()):
+        '''Register a counter'''
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        '''Register a gauge, optionally computed by collect()'''
+        return self._register(Gauge(self, name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        '''Register a histogram'''
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        '''This process's samples as {name: [[labels, value], ...]}'''
+        for metric in self.metrics.values():
+            if isinstance(metric, Gauge):
+                metric.refresh()
+        with self.lock:
+            return {
+                name: [[list(labels), value[:] if isinstance(value, list) else value]
+                       for labels, value in metric.values.items()]
+                for name, metric in self.metrics.items()
+            }
+
+    def flush(self):
+        '''Write this process's snapshot for the other workers to read'''
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump({'pid': os.getpid(), 'metrics': self.snapshot()}, snapshot_file)
+        os.replace(temp_path, path)
+
+    def flush_if_due(self):
+        '''Flush when METRICS_FLUSH_INTERVAL has passed since the last flush'''
+        now = time.monotonic()
+        if self.directory and now >= self._next_flush:
+            self._next_flush = now + self.flush_interval
+            self.flush()
+
+    def _snapshots(self):
+        '''(pid, samples) of every worker, this one included and up to date'''
+        if not self.directory:
+            return [(os.getpid(), self.snapshot())]
+        self.flush()
+        self._next_flush = time.monotonic() + self.flush_interval
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+            snapshots.append((snapshot['pid'], snapshot['metrics']))
+        return snapshots
+
+    def render(self):
+        '''All workers' metrics in the Prometheus text exposition format'''
+        merged = {name: {} for name in self.metrics}
+        for pid, samples in self._snapshots():
+            live = pid == os.getpid() or _is_alive(pid)
+            for name, metric in self.metrics.items():
+                if isinstance(metric, Gauge) and not live:
+                    continue
+                metric.merge(samples.get(name, []), merged[name])
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.render(merged[name]))
+        return '\n'.join(lines) + '\n'
+
+    def _finish_request(self, response):
+        started = g.get('metrics_started')
+        if started is not None:
+            route = _route()
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - started, method=request.method, route=route)
+            REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+            DB_QUERIES.observe(g.get('db_queries', 0), route=route)
+            DB_QUERY_TIME.observe(g.get('db_query_seconds', 0.0), route=route)
+        self.flush_if_due()
+        return response
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _route():
+    '''The matched URL rule, so label values stay bounded'''
+    return request.url_rule.rule if request.url_rule else '<unmatched>'
+
+
+def count_rate_limit_breach(request_limit):
+    '''Flask-Limiter on_breach callback'''
+    RATE_LIMIT_REJECTIONS.inc(route=_route(), limit=str(request_limit.limit))
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_query_seconds = 0.0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments,unused-argument
+    conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments,unused-argument
+    seconds = time.perf_counter() - conn.info['metrics_query_started'].pop()
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+        g.db_query_seconds += seconds
+    for observer in QUERY_OBSERVERS:
+        observer(statement, seconds)
+
+
+def _handle_error(context):
+    '''Drop the start time of a statement that failed, which gets no after_cursor_execute'''
+    started = context.connection.info.get('metrics_query_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+# Called with (statement, seconds) after every statement, see observe_queries()
+QUERY_OBSERVERS = []
+
+
+def _listen_for_queries():
+    '''Time every statement of every engine, once per process'''
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+def observe_queries(observer):
+    '''Call observer(statement, seconds) after every statement of every engine'''
+    _listen_for_queries()
+    if observer not in QUERY_OBSERVERS:
+        QUERY_OBSERVERS.append(observer)
+
+
+def _pool_connections():
+    '''Connections checked out of each engine's pool'''
+    engines = current_app.extensions['sqlalchemy'].engines
+    return [({'database': key or 'default'}, engine.pool.checkedout())
+            for key, engine in engines.items() if hasattr(engine.pool, 'checkedout')]
+
+
+def _slack_log_records_queued():
+    '''Records waiting in this worker's Slack log handler, if it ships to Slack'''
+    # auth.utils.logger imports this module to count shipped records
+    from auth.utils import logger  # pylint: disable=import-outside-toplevel
+    if logger.sinks.slack_handler is None:
+        return []
+    return [({}, logger.sinks.slack_handler.queued)]
+
+
+# Shared with auth.__init__, which calls init_app on it
+metrics = MetricsRegistry()
+
+REQUEST_LATENCY = metrics.histogram(
+    'http_request_duration_seconds', 'Request latency by route', ('method', 'route'))
+REQUESTS = metrics.counter(
+    'http_requests_total', 'Responses by route and status code', ('method', 'route', 'status'))
+DB_QUERIES = metrics.histogram(
+    'db_queries_per_request', 'SQL statements executed per request', ('route',),
+    buckets=COUNT_BUCKETS)
+DB_QUERY_TIME = metrics.histogram(
+    'db_query_seconds_per_request', 'Time spent in SQL statements per request', ('route',))
+PASSWORD_HASH_DURATION = metrics.histogram(
+    'password_hash_duration_seconds', 'Time to hash or verify a password, queueing included',
+    ('operation', 'algorithm'))
+RATE_LIMIT_REJECTIONS = metrics.counter(
+    'rate_limit_rejections_total', 'Requests rejected by a rate limit', ('route', 'limit'))
+REFRESH_TOKEN_REUSE = metrics.counter(
+    'refresh_token_reuse_total', 'Rotated refresh tokens presented again')
+POOL_CONNECTIONS = metrics.gauge(
+    'db_pool_connections_checked_out', 'Database connections in use', ('database',),
+    collect=_pool_connections)
+SLACK_LOG_RECORDS = metrics.counter(
+    'slack_log_records_total', 'Log records sent to Slack, dropped or failed to send',
+    ('state',))
+SLACK_LOG_RECORDS_QUEUED = metrics.gauge(
+    'slack_log_records_queued', 'Log records waiting to be sent to Slack',
+    collect=_slack_log_records_queued)
@@ -0,0 +1,22 @@
+'''Request body size ceilings enforced before the body is read'''
+from functools import wraps
+from flask import current_app, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+def body_limit(name):
+    '''Reject a request whose Content-Length exceeds BODY_LIMIT_<name> bytes with a 413.
+
+    Place it directly under the route decorator so it runs before rate
+    limit key functions that parse the body. Bodies sent without a
+    Content-Length are capped by MAX_CONTENT_LENGTH while they are read.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            limit = current_app.config.get(f'BODY_LIMIT_{name}')
+            if limit is not None and (request.content_length or 0) > limit:
+                raise RequestEntityTooLarge(f"Request body is limited to {limit} bytes")
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
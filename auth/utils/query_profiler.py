@@ -0,0 +1,172 @@
+'''Per-request SQL profiling and N+1 detection.
+
+When a request is profiled, every statement it executes is recorded with
+its duration (as timed by auth.utils.metrics) and the line of application
+code that issued it. The response gets an X-SQL-Profile summary header
+and one record in the log file, kept out of Slack, lists the statements;
+statements executed SQL_PROFILER_REPEAT_THRESHOLD or more times with the
+same SQL (typically a lazy relationship loaded in a loop) are flagged
+and logged as a warning.
+
+Requests are profiled when SQL_PROFILER_ENABLED is set, or when they
+carry the SQL_PROFILER_HEADER request header (disabled in production).
+profile_queries() profiles any block of code the same way, e.g. from
+flask shell.
+'''
+import os
+import sys
+import sysconfig
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import g, request
+from auth.utils.logger import log_success, log_warning
+from auth.utils.metrics import observe_queries
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_DIR = os.path.dirname(PACKAGE_DIR)
+SUMMARY_HEADER = 'X-SQL-Profile'
+LIBRARY_DIRS = tuple({sysconfig.get_path('stdlib'), sysconfig.get_path('purelib'),
+                      sysconfig.get_path('platlib')})
+# This module and the metrics listener that times statements for it
+OWN_FILES = (__file__, observe_queries.__code__.co_filename)
+
+
+def _describe(frame):
+    filename = frame.f_code.co_filename
+    if filename.startswith(PROJECT_DIR):
+        filename = os.path.relpath(filename, PROJECT_DIR)
+    return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+
+def _call_site():
+    '''The innermost auth frame outside the profiler, else the innermost non-library one'''
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    fallback = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename not in OWN_FILES:
+            if filename.startswith(PACKAGE_DIR):
+                return _describe(frame)
+            if fallback is None and not filename.startswith(LIBRARY_DIRS + ('<',)):
+                fallback = frame
+        frame = frame.f_back
+    return _describe(fallback) if fallback is not None else '<unknown>'
+
+
+class QueryProfile:
+    '''Statements executed while profiling, with durations and call sites'''
+
+    def __init__(self):
+        self.statements = []
+
+    def record(self, statement, seconds, call_site):
+        '''Add one executed statement'''
+        self.statements.append((statement, seconds, call_site))
+
+    @property
+    def total_seconds(self):
+        '''Time spent executing the recorded statements'''
+        return sum(seconds for _, seconds, _ in self.statements)
+
+    def repeated(self, threshold):
+        '''[(statement, count, call sites)] of statements run threshold or more times'''
+        runs = defaultdict(list)
+        for statement, _, call_site in self.statements:
+            runs[statement].append(call_site)
+        return sorted(
+            ((statement, len(sites), sorted(set(sites)))
+             for statement, sites in runs.items() if len(sites) >= threshold),
+            key=lambda item: -item[1])
+
+    def summary(self, threshold):
+        '''One-line summary for the response header'''
+        return (f"queries={len(self.statements)}; "
+                f"time_ms={self.total_seconds * 1000:.2f}; "
+                f"repeated={len(self.repeated(threshold))}")
+
+    def report(self, threshold):
+        '''Every statement with its timing and call site, then the repeats'''
+        lines = [f"{seconds * 1000:8.2f}ms  {call_site}  {' '.join(statement.split())}"
+                 for statement, seconds, call_site in self.statements]
+        for statement, count, sites in self.repeated(threshold):
+            lines.append(f"repeated {count}x from {', '.join(sites)}: "
+                         f"{' '.join(statement.split())}")
+        return '\n'.join(lines)
+
+
+class QueryProfiler:
+    '''Profiles the requests that ask for it, with the statement timings of auth.utils.metrics'''
+
+    def __init__(self):
+        self.enabled = False
+        self.header = None
+        self.repeat_threshold = 2
+        self._local = threading.local()
+
+    def init_app(self, app):
+        '''Read the SQL_PROFILER_* settings and profile matching requests'''
+        self.enabled = app.config.get('SQL_PROFILER_ENABLED', self.enabled)
+        self.header = app.config.get('SQL_PROFILER_HEADER', self.header)
+        self.repeat_threshold = app.config.get(
+            'SQL_PROFILER_REPEAT_THRESHOLD', self.repeat_threshold)
+        app.extensions['query_profiler'] = self
+        if not (self.enabled or self.header):
+            return
+        observe_queries(self._record)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    @property
+    def active(self):
+        '''The profile collecting this thread's statements, if any'''
+        return getattr(self._local, 'profile', None)
+
+    @contextmanager
+    def profile(self):
+        '''Profile the statements executed by this thread inside the block'''
+        observe_queries(self._record)
+        previous = self.active
+        self._local.profile = QueryProfile()
+        try:
+            yield self._local.profile
+        finally:
+            self._local.profile = previous
+
+    def _record(self, statement, seconds):
+        profile = self.active
+        if profile is not None:
+            profile.record(statement, seconds, _call_site())
+
+    def _start_request(self):
+        if self.enabled or (self.header and request.headers.get(self.header)):
+            self._local.profile = QueryProfile()
+
+    def _finish_request(self, response):
+        profile = self.active
+        if profile is None:
+            return response
+        self._local.profile = None
+        route = request.url_rule.rule if request.url_rule else request.path
+        summary = profile.summary(self.repeat_threshold)
+        response.headers[SUMMARY_HEADER] = summary
+        log = log_warning if profile.repeated(self.repeat_threshold) else log_success
+        # The statement list is for the log file, not Slack
+        log('query_profiler',
+            f"{request.method} {route} {summary}\n{profile.report(self.repeat_threshold)}",
+            request_id=g.get('request_id'), method=request.method, route=route,
+            local_only=True)
+        return response
+
+    def _teardown_request(self, exc):  # pylint: disable=unused-argument
+        self._local.profile = None
+
+
+# Shared with auth.__init__, which calls init_app on it
+query_profiler = QueryProfiler()
+
+
+def profile_queries():
+    '''Context manager: profile the statements executed in the block'''
+    return query_profiler.profile()
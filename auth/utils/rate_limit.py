@@ -0,0 +1,224 @@
+'''Rate limiting: request keys and a shared SQL storage backend'''
+import time
+from flask import current_app, request
+from flask_limiter.util import get_remote_address
+from limits.storage import MovingWindowSupport, Storage
+from sqlalchemy import (
+    Column, Float, Integer, MetaData, String, Table, create_engine, delete, event,
+    func, insert, select, text, update
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from auth.utils.identity import current_identity
+from auth.utils.validation import normalize_email
+
+
+def route_limit(name):
+    '''Return a callable reading the RATELIMIT_<name> limit string from the app config'''
+    return lambda: current_app.config[f'RATELIMIT_{name}']
+
+
+def email_and_ip():
+    '''Rate limit key: normalised email in the JSON body plus client IP'''
+    data = request.get_json(silent=True)
+    email = data.get('email') if isinstance(data, dict) else None
+    email = normalize_email(email) if isinstance(email, str) else ''
+    return f"{email}|{get_remote_address()}"
+
+
+def identity_or_ip():
+    '''Rate limit key: the token's identity, or the client IP without a valid token'''
+    identity = current_identity()
+    return f"user:{identity}" if identity else get_remote_address()
+
+
+class SQLStorage(Storage, MovingWindowSupport):
+    '''limits storage in a SQL table, shared by every worker using the same database.
+
+    Use a URI of the form sql+<sqlalchemy url>, e.g.
+    sql+sqlite:////var/run/auth/ratelimit.db. Pointing it at a SQLite
+    file on local disk gives all gunicorn workers of a node one set of
+    counters at the cost of a local file write rather than a network
+    round trip; for limits shared across nodes use redis:// against a
+    Redis-compatible server instead.
+
+    Fixed windows are rows in rate_limit_counters; the moving window
+    strategy stores one row per hit in rate_limit_events, and keeps the
+    end of the key's latest window in its counter row. Every
+    cleanup_interval seconds (a RATELIMIT_STORAGE_OPTIONS entry, default
+    60) a hit also deletes up to cleanup_batch_size keys whose window
+    has ended, so keys that are never hit again don't pile up.
+    '''
+    STORAGE_SCHEME = ['sql+sqlite', 'sql+postgresql', 'sql+mysql']
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        self.cleanup_interval = options.pop('cleanup_interval', 60)
+        self.cleanup_batch_size = options.pop('cleanup_batch_size', 1000)
+        self._next_cleanup = time.time() + self.cleanup_interval
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        url = uri.split('+', 1)[1]
+        self.engine = create_engine(url, **options)
+        if self.engine.dialect.name == 'sqlite':
+            self._serialize_sqlite_writes()
+        metadata = MetaData()
+        self.counters = Table(
+            'rate_limit_counters', metadata,
+            Column('key', String(255), primary_key=True),
+            Column('count', Integer, nullable=False),
+            Column('expires_at', Float, nullable=False),
+        )
+        self.events = Table(
+            'rate_limit_events', metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('key', String(255), nullable=False, index=True),
+            Column('created_at', Float, nullable=False),
+        )
+        metadata.create_all(self.engine)
+
+    def _serialize_sqlite_writes(self):
+        '''Take SQLite's write lock at BEGIN so read-then-write is atomic'''
+        @event.listens_for(self.engine, 'connect')
+        def disable_pysqlite_begin(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(self.engine, 'begin')
+        def begin_immediate(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    @property
+    def base_exceptions(self):
+        return SQLAlchemyError
+
+    def _lock_counter(self, connection, key):
+        '''Select a counter row, locking it where the database supports it.
+
+        A missing row is first created already expired. Concurrent first
+        hits on a key may all try to create it, so the insert skips a row
+        that another connection has just added.
+        '''
+        query = (select(self.counters.c.count, self.counters.c.expires_at)
+                 .where(self.counters.c.key == key)
+                 .with_for_update())
+        row = connection.execute(query).first()
+        if row is None:
+            connection.execute(self._insert_if_missing(key=key, count=0, expires_at=0))
+            row = connection.execute(query).first()
+        return row
+
+    def _insert_if_missing(self, **values):
+        '''INSERT into rate_limit_counters that does nothing if the key exists'''
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            return postgresql.insert(self.counters).values(**values).on_conflict_do_nothing()
+        if dialect == 'sqlite':
+            return sqlite.insert(self.counters).values(**values).on_conflict_do_nothing()
+        return insert(self.counters).values(**values).prefix_with('IGNORE')
+
+    def _maybe_clean_up(self):
+        if time.time() >= self._next_cleanup:
+            self._next_cleanup = time.time() + self.cleanup_interval
+            self.delete_expired(self.cleanup_batch_size)
+
+    def delete_expired(self, batch_size=1000):
+        '''Delete up to batch_size keys whose window has ended; return how many'''
+        now = time.time()
+        with self.engine.begin() as connection:
+            # Locked, so a hit on one of these keys waits for the delete and
+            # one that got there first moves expires_at out of the batch
+            keys = connection.execute(
+                select(self.counters.c.key)
+                .where(self.counters.c.expires_at <= now)
+                .limit(batch_size)
+                .with_for_update()
+                ).scalars().all()
+            if not keys:
+                return 0
+            connection.execute(delete(self.events).where(self.events.c.key.in_(keys)))
+            connection.execute(delete(self.counters).where(self.counters.c.key.in_(keys)))
+        return len(keys)
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        self._maybe_clean_up()
+        now = time.time()
+        with self.engine.begin() as connection:
+            row = self._lock_counter(connection, key)
+            if row.expires_at <= now:
+                count, expires_at = amount, now + expiry
+            else:
+                count = row.count + amount
+                expires_at = now + expiry if elastic_expiry else row.expires_at
+            connection.execute(
+                update(self.counters).where(self.counters.c.key == key)
+                .values(count=count, expires_at=expires_at))
+            return count
+
+    def get(self, key):
+        with self.engine.connect() as connection:
+            row = connection.execute(
+                select(self.counters.c.count)
+                .where(self.counters.c.key == key, self.counters.c.expires_at > time.time())
+                ).first()
+        return row.count if row else 0
+
+    def get_expiry(self, key):
+        with self.engine.connect() as connection:
+            expires_at = connection.execute(
+                select(self.counters.c.expires_at).where(self.counters.c.key == key)
+                ).scalar()
+        return int(expires_at or time.time())
+
+    def check(self):
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            return True
+        except SQLAlchemyError:
+            return False
+
+    def reset(self):
+        with self.engine.begin() as connection:
+            cleared = connection.execute(delete(self.counters)).rowcount
+            cleared += connection.execute(delete(self.events)).rowcount
+        return cleared
+
+    def clear(self, key):
+        with self.engine.begin() as connection:
+            connection.execute(delete(self.counters).where(self.counters.c.key == key))
+            connection.execute(delete(self.events).where(self.events.c.key == key))
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        self._maybe_clean_up()
+        now = time.time()
+        with self.engine.begin() as connection:
+            # Serialise hits on this key through its counter row
+            self._lock_counter(connection, key)
+            connection.execute(delete(self.events).where(
+                self.events.c.key == key, self.events.c.created_at <= now - expiry))
+            # pylint can't see through SQLAlchemy's func generator (E1102)
+            in_window = connection.execute(
+                select(func.count()).select_from(self.events)  # pylint: disable=not-callable
+                .where(self.events.c.key == key)
+                ).scalar()
+            if in_window + amount > limit:
+                return False
+            connection.execute(
+                insert(self.events), [{'key': key, 'created_at': now}] * amount)
+            # Every event of the key is outside its window from then on
+            connection.execute(
+                update(self.counters).where(self.counters.c.key == key)
+                .values(expires_at=now + expiry))
+            return True
+
+    def get_moving_window(self, key, limit, expiry):
+        with self.engine.connect() as connection:
+            oldest, count = connection.execute(
+                select(func.min(self.events.c.created_at),
+                       func.count())  # pylint: disable=not-callable
+                .where(self.events.c.key == key,
+                       self.events.c.created_at > time.time() - expiry)
+                ).first()
+        if not count:
+            return int(time.time()), 0
+        return int(oldest), count
@@ -1,10 +1,11 @@
 '''To work with jwt'''
 from datetime import datetime, timezone
 from flask_jwt_extended import decode_token
+from auth.utils.identity import token_cache
 
 def is_token_expired(token):
     '''Check if token is expired'''
-    decoded_token = decode_token(token)
+    decoded_token = token_cache.get(token) or decode_token(token, allow_expired=True)
     if not decoded_token:
         return True
     exp_timestamp = decoded_token.get('exp')
@@ -0,0 +1,58 @@
+'''Bounded cache of verified access tokens'''
+import hashlib
+from auth.utils.ttl_cache import TTLCache
+
+
+class VerifiedTokenCache(TTLCache):
+    '''LRU cache mapping a hash of a raw access token to its verified claims.
+
+    An entry lives until the token's exp or max_ttl seconds, whichever
+    comes first, so a revocation made by another process is honoured
+    within max_ttl. Revocations made in this process evict matching
+    entries immediately through evict_jti() and evict_identity().
+    '''
+
+    def __init__(self, app=None):
+        super().__init__(max_size=10000, ttl=60)
+        self.switched_on = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):  # pylint: disable=arguments-differ
+        '''Read the TOKEN_CACHE_* settings from the app config'''
+        self.switched_on = app.config.get('TOKEN_CACHE_ENABLED', self.switched_on)
+        super().init_app(app, 'TOKEN_CACHE')
+        self.ttl = app.config.get('TOKEN_CACHE_MAX_TTL', self.ttl)
+
+    @property
+    def enabled(self):
+        '''Whether tokens are cached: TOKEN_CACHE_ENABLED and a positive size and TTL'''
+        return self.switched_on and super().enabled
+
+    @property
+    def max_ttl(self):
+        '''The longest an entry lives, in seconds'''
+        return self.ttl
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token, default=None):  # pylint: disable=arguments-renamed
+        '''Return the cached claims for a raw token, or None'''
+        return super().get(self._key(token), default)
+
+    def put(self, token, claims, expires_at=None):  # pylint: disable=arguments-renamed
+        '''Cache the claims of a token that has just been verified'''
+        if claims.get('type') != 'access':
+            return
+        super().put(self._key(token), claims, claims.get('exp') or expires_at)
+
+    def evict_jti(self, jti):
+        '''Drop the entry of a revoked token'''
+        return self.evict(lambda claims: claims.get('jti') == jti)
+
+    def evict_identity(self, identity, issued_before=None):
+        '''Drop the entries of a user's tokens, optionally only those issued before a timestamp'''
+        return self.evict(lambda claims: claims.get('sub') == identity and (
+            issued_before is None or claims.get('iat', 0) < issued_before))
@@ -0,0 +1,95 @@
+'''Bounded in-process LRU cache whose entries expire'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''LRU cache of up to max_size entries, each living at most ttl seconds.
+
+    init_app(app, prefix) reads <prefix>_SIZE and <prefix>_TTL from the
+    app config; a ttl of 0 disables the cache.
+    '''
+
+    def __init__(self, max_size=1024, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, prefix):
+        '''Read the <prefix>_SIZE and <prefix>_TTL settings from the app config'''
+        self.max_size = app.config.get(f'{prefix}_SIZE', self.max_size)
+        self.ttl = app.config.get(f'{prefix}_TTL', self.ttl)
+        self.clear()
+        app.extensions[prefix.lower()] = self
+
+    @property
+    def enabled(self):
+        '''Whether entries are kept at all'''
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, key, default=None):
+        '''Return the live value for key, or default'''
+        if not self.enabled:
+            return default
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, expires_at=None):
+        '''Store value for ttl seconds, or until expires_at if that is sooner'''
+        if not self.enabled:
+            return
+        deadline = time.time() + self.ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        with self._lock:
+            self._entries[key] = (value, deadline)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        '''Drop one entry'''
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.evictions += 1
+
+    def evict(self, predicate):
+        '''Drop every entry whose value matches predicate'''
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+            self.evictions += len(keys)
+        return len(keys)
+
+    def clear(self):
+        '''Drop every entry'''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''Return the cache counters'''
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
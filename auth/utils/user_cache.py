@@ -0,0 +1,78 @@
+'''Per-process cache of user credentials for logins and password changes.
+
+Entries are plain dicts (id, username, email, email_normalized,
+password_hash), never ORM instances, so they can be shared between
+threads. Users are cached by id, and an email index maps each
+normalized email to the id.
+
+Entries are dropped whenever a user row is updated or deleted (see
+BaseModel.on_change), but a worker can't see writes made by other
+workers: there a changed password may keep working for up to
+USER_CACHE_TTL seconds. Password hashes never leave the process, so
+there is no shared backend; the cache is off unless USER_CACHE_TTL is
+set.
+'''
+from auth.utils.ttl_cache import TTLCache
+
+FIELDS = ('id', 'username', 'email', 'email_normalized', 'password_hash')
+
+
+class UserCache:
+    '''Users by id and by normalized email, in a per-process TTLCache'''
+
+    def __init__(self):
+        self.ttl = 0
+        self._local = TTLCache()
+
+    def init_app(self, app):
+        '''Read the USER_CACHE_* settings from the app config'''
+        self._local.init_app(app, 'USER_CACHE')
+        self.ttl = self._local.ttl
+        app.extensions['user_cache'] = self
+
+    @property
+    def enabled(self):
+        '''Whether users are cached at all'''
+        return self.ttl > 0
+
+    def get_by_id(self, user_id):
+        '''The cached user with this id, or None'''
+        if not self.enabled:
+            return None
+        return self._local.get(f'user:id:{user_id}')
+
+    def get_by_email(self, email_normalized):
+        '''The cached user with this normalized email, or None'''
+        if not self.enabled:
+            return None
+        user_id = self._local.get(f'user:email:{email_normalized}')
+        user = self.get_by_id(user_id) if user_id is not None else None
+        # The index can point at a user whose email has since changed
+        if user is None or user['email_normalized'] != email_normalized:
+            return None
+        return user
+
+    def put(self, user):
+        '''Cache a User row; return its cached form'''
+        entry = {field: getattr(user, field) for field in FIELDS}
+        if self.enabled:
+            self._local.put(f'user:id:{entry["id"]}', entry)
+            self._local.put(f'user:email:{entry["email_normalized"]}', entry['id'])
+        return entry
+
+    def invalidate(self, user_id):
+        '''Forget a user; its email index entry is ignored until overwritten'''
+        if self.enabled:
+            self._local.pop(f'user:id:{user_id}')
+
+    def clear(self):
+        '''Forget every user'''
+        self._local.clear()
+
+    def stats(self):
+        '''Hit and miss counters'''
+        return self._local.stats()
+
+
+# Shared with auth.__init__, which calls init_app on it
+user_cache = UserCache()
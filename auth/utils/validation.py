@@ -1,19 +1,29 @@
 '''Validate inputs'''
 import re
 
+# Compiled once at import; every check is a single match call
+EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$')
+# Example: Minimum 8 characters, at least one letter and one number
+PASSWORD_REGEX = re.compile(r'^(?=.*[A-Za-z])(?=.*\d)[A-Za-z\d]{8,}$')
+# Example: Only allow alphanumeric characters and underscores
+USERNAME_REGEX = re.compile(r'^\w+$')
+
+EMAIL_VALIDATION_ERROR = 'Invalid email address'
+PASSWORD_VALIDATION_ERROR = 'Password must be at least 8 char, at least one letter and one number'
+USERNAME_VALIDATION_ERROR = 'Username can only contain alphanumeric characters and underscores'
+
 def validate_email(email):
     ''' Validate Email address'''
-    email_regex = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
-    return re.match(email_regex, email) is not None
+    return EMAIL_REGEX.match(email) is not None
 
 def validate_password(password):
     ''' Validate Password'''
-    # Example: Minimum 8 characters, at least one letter and one number
-    password_regex = r'^(?=.*[A-Za-z])(?=.*\d)[A-Za-z\d]{8,}$'
-    return re.match(password_regex, password) is not None
+    return PASSWORD_REGEX.match(password) is not None
 
 def validate_username(username):
     ''' Validate Username'''
-    # Example: Only allow alphanumeric characters and underscores
-    username_regex = r'^\w+$'
-    return re.match(username_regex, username) is not None
+    return USERNAME_REGEX.match(username) is not None
+
+def normalize_email(email):
+    '''Canonical form of an email address for uniqueness checks and lookups'''
+    return email.strip().lower()
@@ -0,0 +1,22 @@
+'''Benchmarks for the auth service'''
+import os
+
+
+def create_testing_app():
+    ''' create_app() with TestingConfig, refusing to run against any other database
+
+    The benchmarks drop and recreate every table, so they must never
+    pick up a development or production FLASK_ENV from the shell.
+    '''
+    # pylint: disable=import-outside-toplevel
+    os.environ['FLASK_ENV'] = 'testing'
+    from auth import create_app
+    from auth.config import TestingConfig
+
+    app = create_app()
+    database = app.config['SQLALCHEMY_DATABASE_URI']
+    if database != TestingConfig.SQLALCHEMY_DATABASE_URI:
+        raise SystemExit(
+            f'Refusing to drop tables in {database}: benchmarks only run against '
+            f'{TestingConfig.SQLALCHEMY_DATABASE_URI}')
+    return app
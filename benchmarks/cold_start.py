@@ -0,0 +1,87 @@
+''' Benchmark: cold start of a worker process
+
+Usage:
+    python -m benchmarks.cold_start [--runs 10]
+
+Starts a fresh interpreter per run, the way gunicorn starts a worker
+without --preload, and times importing the auth package, create_app()
+and the first request to the API spec. Also counts the SQL statements
+and threads started before the app serves anything; both should stay
+at zero so a scale-out never touches the database on boot.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+
+def measure():
+    ''' Time one cold start in this (fresh) process '''
+    # pylint: disable=import-outside-toplevel
+    os.environ.setdefault('FLASK_ENV', 'testing')
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    statements = []
+    event.listen(Engine, 'before_cursor_execute',
+                 lambda *args, **kwargs: statements.append(args[2]))
+    threads = threading.active_count()
+
+    started = time.perf_counter()
+    from auth import create_app
+    imported = time.perf_counter()
+    app = create_app()
+    created = time.perf_counter()
+    boot_statements = len(statements)
+    boot_threads = threading.active_count() - threads
+
+    response = app.test_client().get('/apispec_1.json')
+    spec_built = time.perf_counter()
+    return {
+        'import_ms': (imported - started) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_apispec_ms': (spec_built - created) * 1000,
+        'apispec_status': response.status_code,
+        'boot_statements': boot_statements,
+        'boot_threads': boot_threads,
+    }
+
+
+def main():
+    ''' Run the benchmark and print the results as JSON '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure()))
+        return
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.cold_start', '--child'],
+            cwd=root, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    results = {'runs': args.runs}
+    for field in ('import_ms', 'create_app_ms', 'first_apispec_ms'):
+        values = [run[field] for run in runs]
+        results[field] = {
+            'median': round(statistics.median(values), 2),
+            'min': round(min(values), 2),
+            'max': round(max(values), 2),
+        }
+    for field in ('apispec_status', 'boot_statements', 'boot_threads'):
+        results[field] = max(run[field] for run in runs)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+''' Microbenchmark: JWT verifications per request and their cost
+
+Usage:
+    python -m benchmarks.jwt_verification [--iterations 2000]
+
+Counts how many times the JWT is verified while serving each route, and
+times verify_jwt_in_request() so the per-request saving of verifying
+once instead of twice (once in @jwt_required, again in log_route) can
+be read off directly. Runs against the testing SQLite database, which is
+dropped and recreated first.
+'''
+import argparse
+import json
+import time
+from flask_jwt_extended import verify_jwt_in_request, view_decorators
+from auth import db
+from auth.services.auth_service import AuthService
+from benchmarks import create_testing_app
+
+
+class VerificationCounter:  # pylint: disable=too-few-public-methods
+    ''' Wraps the decode_token used by verify_jwt_in_request to count verifications '''
+
+    def __init__(self):
+        self.calls = 0
+        self.original = view_decorators.decode_token
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.original(*args, **kwargs)
+
+
+def time_verifications(app, token, iterations, verifications):
+    ''' Mean microseconds spent verifying the token `verifications` times per request '''
+    headers = {'Authorization': f'Bearer {token}'}
+    started = time.perf_counter()
+    for _ in range(iterations):
+        with app.test_request_context('/', headers=headers):
+            for _ in range(verifications):
+                verify_jwt_in_request()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    ''' Run the benchmark and print the results as JSON '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_testing_app()
+    app.config['RATELIMIT_ENABLED'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all(bind_key=None)
+        AuthService.register_user('bench', 'bench@example.com', 'bench1234')
+        tokens, _ = AuthService.authenticate_user('bench@example.com', 'bench1234')
+    access = {'Authorization': f"Bearer {tokens['access_token']}"}
+    refresh = {'Authorization': f"Bearer {tokens['refresh_token']}"}
+
+    counter = VerificationCounter()
+    view_decorators.decode_token = counter
+    client = app.test_client()
+    verifications = {}
+    requests_to_count = [
+        ('GET /test (with token)', lambda: client.get('/api/v1/auth/test', headers=access)),
+        ('POST /login', lambda: client.post(
+            '/api/v1/auth/login',
+            json={'email': 'bench@example.com', 'password': 'bench1234'})),
+        ('POST /refresh', lambda: client.post('/api/v1/auth/refresh', headers=refresh)),
+        # Last: changing the password revokes every token issued so far
+        ('POST /change-password', lambda: client.post(
+            '/api/v1/auth/change-password', headers=access,
+            json={'current_password': 'bench1234', 'new_password': 'bench1234'})),
+    ]
+    for name, send in requests_to_count:
+        counter.calls = 0
+        send()
+        verifications[name] = counter.calls
+    view_decorators.decode_token = counter.original
+
+    with app.app_context():
+        tokens, _ = AuthService.authenticate_user('bench@example.com', 'bench1234')
+    once = time_verifications(app, tokens['access_token'], args.iterations, 1)
+    twice = time_verifications(app, tokens['access_token'], args.iterations, 2)
+    print(json.dumps({
+        'jwt_verifications_per_request': verifications,
+        'verify_once_us': round(once, 1),
+        'verify_twice_us': round(twice, 1),
+        'saved_per_request_us': round(twice - once, 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+''' Load test: latency, throughput and database work of the auth endpoints
+
+Usage:
+    python -m benchmarks.load_test [--requests 200] [--concurrency 4]
+        [--endpoints register,login,refresh,change-password,reset-password]
+        [--scrypt-log-n 15] [--output results.json]
+        [--baseline baseline.json] [--tolerance 10]
+
+Drives each endpoint in turn through create_app()'s test client from
+--concurrency threads against the testing SQLite database, which is
+dropped and recreated first; any other database is refused. Every request gets its own user or token
+(seeded in bulk beforehand), so password changes and refresh token
+rotation never invalidate another request's credentials.
+
+For every endpoint it reports requests per second, p50/p95/p99 latency
+in milliseconds, status codes, and the SQL statements and commits per
+request, counted with engine events in the thread serving the request.
+With --baseline, the results are compared against an earlier --output
+file. An endpoint whose p95 or throughput got worse by more than
+--tolerance percent, or that issues half a statement or commit more
+per request, is listed under "regressions" and the exit status is 1.
+'''
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+API = '/api/v1/auth'
+PASSWORD = 'load1234'
+NEW_PASSWORD = 'load5678'
+ENDPOINTS = ('register', 'login', 'refresh', 'change-password', 'reset-password')
+
+
+class DatabaseCounters(threading.local):
+    ''' Statements and commits executed by the current thread '''
+    queries = 0
+    commits = 0
+
+    def count_query(self, *args, **kwargs):  # pylint: disable=unused-argument
+        ''' before_cursor_execute listener '''
+        self.queries += 1
+
+    def count_commit(self, *args, **kwargs):  # pylint: disable=unused-argument
+        ''' commit listener '''
+        self.commits += 1
+
+
+def seed_users(prefix, count):
+    ''' Bulk insert count users sharing one password hash; return their ids '''
+    # pylint: disable=import-outside-toplevel
+    from auth import db, hasher
+    from auth.models.models import User
+    from auth.services.user_transfer import import_users
+
+    password_hash = hasher.hash(PASSWORD)
+    import_users(((i + 1, {
+        'username': f'{prefix}{i}',
+        'email': f'{prefix}{i}@load.test',
+        'password_hash': password_hash,
+    }) for i in range(count)), batch_size=1000)
+    ids = dict(db.session.query(User.username, User.id)
+               .filter(User.username.like(f'{prefix}%')))
+    return [ids[f'{prefix}{i}'] for i in range(count)]
+
+
+def prepare(endpoint, count):
+    ''' Build the keyword arguments of count requests to endpoint '''
+    # pylint: disable=import-outside-toplevel,protected-access
+    from auth import db
+    from auth.models.base import get_uuid
+    from auth.services.auth_service import AuthService
+
+    if endpoint == 'register':
+        return [{'json': {'username': f'new{i}', 'email': f'new{i}@load.test',
+                          'password': PASSWORD}} for i in range(count)]
+    prefix = endpoint.replace('-', '')[:8]
+    user_ids = seed_users(prefix, count)
+    if endpoint == 'login':
+        return [{'json': {'email': f'{prefix}{i}@load.test', 'password': PASSWORD}}
+                for i in range(count)]
+    if endpoint == 'refresh':
+        tokens = [AuthService._issue_refresh_token(user_id, get_uuid()) for user_id in user_ids]
+    else:
+        tokens = [AuthService._create_access_token(user_id) for user_id in user_ids]
+    db.session.commit()
+    body = {'new_password': NEW_PASSWORD}
+    if endpoint == 'change-password':
+        body['current_password'] = PASSWORD
+    return [{'headers': {'Authorization': f'Bearer {token}'},
+             'json': None if endpoint == 'refresh' else body} for token in tokens]
+
+
+def warm_up(app):
+    ''' Send one invalid request per endpoint so first-use setup isn't timed '''
+    client = app.test_client()
+    for endpoint in ENDPOINTS:
+        client.post(f'{API}/{endpoint}', json={})
+
+
+def run(app, endpoint, requests, concurrency, counters):
+    ''' Send the prepared requests from concurrency threads; return the samples and wall time '''
+    clients = threading.local()
+
+    def send(kwargs):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        counters.queries = counters.commits = 0
+        started = time.perf_counter()
+        response = clients.client.post(f'{API}/{endpoint}', **kwargs)
+        latency = time.perf_counter() - started
+        return latency, response.status_code, counters.queries, counters.commits
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(send, requests))
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, elapsed):
+    ''' Latency percentiles, throughput and database work of one endpoint '''
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive') \
+        if len(latencies) > 1 else latencies * 99
+    statuses = {}
+    for _, status, _, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if not 200 <= sample[1] < 300),
+        'statuses': statuses,
+        'rps': round(len(samples) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(cuts[49], 2),
+            'p95': round(cuts[94], 2),
+            'p99': round(cuts[98], 2),
+            'mean': round(statistics.fmean(latencies), 2),
+            'max': round(latencies[-1], 2),
+        },
+        'queries_per_request': round(statistics.fmean(sample[2] for sample in samples), 2),
+        'commits_per_request': round(statistics.fmean(sample[3] for sample in samples), 2),
+    }
+
+
+def compare(results, baseline, tolerance):
+    ''' Per-endpoint changes against a baseline and the list of regressions '''
+    regressions = []
+    for endpoint, current in results['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if not before:
+            continue
+        p95_change = (current['latency_ms']['p95'] / before['latency_ms']['p95'] - 1) * 100
+        rps_change = (current['rps'] / before['rps'] - 1) * 100
+        current['vs_baseline'] = {
+            'p95_change_pct': round(p95_change, 1),
+            'rps_change_pct': round(rps_change, 1),
+            'queries_per_request': round(
+                current['queries_per_request'] - before['queries_per_request'], 2),
+            'commits_per_request': round(
+                current['commits_per_request'] - before['commits_per_request'], 2),
+        }
+        if p95_change > tolerance:
+            regressions.append(f'{endpoint}: p95 latency {p95_change:+.1f}%')
+        if rps_change < -tolerance:
+            regressions.append(f'{endpoint}: throughput {rps_change:+.1f}%')
+        # Periodic revocation syncs add fractions of a query; flag whole ones
+        for field in ('queries_per_request', 'commits_per_request'):
+            if current[field] - before[field] >= 0.5:
+                regressions.append(
+                    f'{endpoint}: {field} {before[field]} -> {current[field]}')
+    return regressions
+
+
+def main():
+    ''' Run the load test and print the results as JSON '''
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4, help='Client threads')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--scrypt-log-n', type=int, default=None,
+                        help='Override PASSWORD_SCRYPT_LOG_N (hashing dominates otherwise)')
+    parser.add_argument('--output', default=None, help='Also write the results to this file')
+    parser.add_argument('--baseline', default=None, help='Results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help='Allowed p95/throughput change in percent')
+    args = parser.parse_args()
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(',') if endpoint.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    # The config classes read the environment when auth is first imported
+    if args.scrypt_log_n is not None:
+        os.environ['PASSWORD_SCRYPT_LOG_N'] = str(args.scrypt_log_n)
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from auth import db
+    from benchmarks import create_testing_app
+
+    app = create_testing_app()
+    app.config['RATELIMIT_ENABLED'] = False
+    counters = DatabaseCounters()
+    results = {
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'database': app.config['SQLALCHEMY_DATABASE_URI'],
+            'hash_algorithm': app.config['PASSWORD_HASH_ALGORITHM'],
+            'scrypt_log_n': app.config['PASSWORD_SCRYPT_LOG_N'],
+            'hash_backend': app.config['PASSWORD_HASH_BACKEND'],
+        },
+        'endpoints': {},
+    }
+    with app.app_context():
+        db.drop_all()
+        db.create_all(bind_key=None)
+    warm_up(app)
+
+    event.listen(Engine, 'before_cursor_execute', counters.count_query)
+    event.listen(Engine, 'commit', counters.count_commit)
+    for endpoint in endpoints:
+        with app.app_context():
+            requests = prepare(endpoint, args.requests)
+        samples, elapsed = run(app, endpoint, requests, args.concurrency, counters)
+        results['endpoints'][endpoint] = summarize(samples, elapsed)
+    event.remove(Engine, 'before_cursor_execute', counters.count_query)
+    event.remove(Engine, 'commit', counters.count_commit)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        results['regressions'] = regressions
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 """ Manage script for Flask application """
+import json
 import os
+import click
 from flask_migrate import Migrate
-from auth import create_app, db
+from auth import create_app, db, key_ring
 from auth.models.models import User
+from auth.services.token_sweeper import sweep_expired_refresh_tokens, sweep_expired_revocations
+from auth.services.user_transfer import (
+    FORMATS, Checkpoint, export_users, format_for, import_users, read_records
+)
 
 # Initialize Flask app
 app = create_app()
@@ -13,6 +19,100 @@ def make_shell_context():
     ''' Shell context for Flask CLI '''
     return {'app': app, 'db': db, 'User': User}
 
+@app.cli.command('sweep-tokens')
+@click.option('--batch-size', default=None, type=int, help='Rows deleted per batch')
+@click.option('--max-batches', default=None, type=int, help='Stop after this many batches')
+def sweep_tokens(batch_size, max_batches):
+    ''' Delete expired refresh tokens and revocations in batches '''
+    batch_size = batch_size or app.config['TOKEN_SWEEP_BATCH_SIZE']
+    for name, sweep in (('refresh tokens', sweep_expired_refresh_tokens),
+                        ('revocations', sweep_expired_revocations)):
+        stats = sweep(batch_size, max_batches)
+        click.echo(
+            f"Deleted {stats['deleted']} expired {name} in {stats['batches']} batches "
+            f"({stats['seconds']}s, {stats['rows_per_second']} rows/sec)")
+
+@app.cli.command('import-users')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+              help='Input format (default: from the file extension)')
+@click.option('--batch-size', default=1000, type=int, help='Records per insert and commit')
+@click.option('--checkpoint', default=None, type=click.Path(dir_okay=False),
+              help='File recording progress; re-run with it to resume')
+@click.option('--rejects', default=None, type=click.File('w', encoding='utf-8'),
+              help='Write rejected records with the reason as JSONL')
+def import_users_command(source, fmt, batch_size, checkpoint, rejects):
+    ''' Import users from a CSV or JSONL file ("-" for stdin) '''
+    fmt = fmt or format_for(source.name)
+    try:
+        progress = Checkpoint(checkpoint, os.path.abspath(source.name))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if progress.line:
+        click.echo(f"Resuming after line {progress.line}", err=True)
+
+    def on_reject(line_number, record, reason):
+        if rejects is not None:
+            rejects.write(json.dumps({
+                'line': line_number,
+                'reason': reason,
+                'username': record.get('username'),
+                'email': record.get('email'),
+            }) + '\n')
+
+    def on_progress(totals):
+        click.echo(f"Imported {totals['imported']}, skipped {totals['skipped']}", err=True)
+
+    stats = import_users(
+        read_records(source, fmt), batch_size, progress, on_reject, on_progress)
+    click.echo(
+        f"Imported {stats['imported']} users, skipped {stats['skipped']} "
+        f"({stats['seconds']}s, {stats['rows_per_second']} records/sec)")
+
+@app.cli.command('export-users')
+@click.argument('destination', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+              help='Output format (default: from the file extension, else csv)')
+@click.option('--with-hashes', is_flag=True, help='Include password hashes')
+@click.option('--batch-size', default=1000, type=int, help='Rows fetched per round trip')
+def export_users_command(destination, fmt, with_hashes, batch_size):
+    ''' Stream every user to a CSV or JSONL file ("-" for stdout) '''
+    count = export_users(
+        destination, fmt or format_for(destination.name), with_hashes, batch_size)
+    click.echo(f"Exported {count} users", err=True)
+
+@app.cli.command('rotate-keys')
+def rotate_keys():
+    ''' Schedule the next JWT signing key when due and delete retired keys '''
+    if not key_ring.enabled:
+        raise click.ClickException(
+            f"JWT_ALGORITHM {app.config['JWT_ALGORITHM']} does not use the key ring")
+    created, deleted = key_ring.rotate()
+    for kid in created:
+        click.echo(f"Scheduled signing key {kid}")
+    for kid in deleted:
+        click.echo(f"Deleted retired signing key {kid}")
+    current = key_ring.signing_key()
+    click.echo(f"Signing with {current.kid if current else 'no key'}")
+
+@app.cli.command('build-apispec')
+@click.argument('destination', type=click.Path(dir_okay=False), required=False)
+def build_apispec(destination):
+    ''' Write the Swagger spec to a file served instead of building it at runtime '''
+    destination = destination or app.config['SWAGGER_SPEC_FILE']
+    if not destination:
+        raise click.ClickException('Pass a destination or set SWAGGER_SPEC_FILE')
+    swagger = getattr(app, 'swag', None)
+    if swagger is None:
+        raise click.ClickException('SWAGGER_ENABLED is off')
+    # Build from the routes, not from a previously written file
+    swagger.apispecs.pop('apispec_1', None)
+    with app.test_request_context():
+        spec = swagger.get_apispecs('apispec_1')
+    with open(destination, 'w', encoding='utf-8') as spec_file:
+        json.dump(spec, spec_file, indent=2, sort_keys=True, default=str)
+    click.echo(f"Wrote {len(spec.get('paths', {}))} paths to {destination}")
+
 # TO Run Migration
 #     # Ensure the migrations folder exists
 #     if not os.path.exists('migrations'):
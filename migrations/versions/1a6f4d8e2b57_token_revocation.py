@@ -0,0 +1,53 @@
+"""Add revoked token and per-user token cutoff tables
+
+Revision ID: 1a6f4d8e2b57
+Revises: e7d2b9a61c40
+Create Date: 2026-10-17 14:45:19.772031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a6f4d8e2b57'
+down_revision = 'e7d2b9a61c40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('revokedtokens',
+    sa.Column('jti', sa.String(length=36), nullable=False),
+    sa.Column('user_id', sa.String(length=255), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id'),
+    sa.UniqueConstraint('jti')
+    )
+    with op.batch_alter_table('revokedtokens', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_revokedtokens_expires_at'), ['expires_at'], unique=False)
+
+    op.create_table('tokencutoffs',
+    sa.Column('user_id', sa.String(length=255), nullable=False),
+    sa.Column('not_before', sa.Float(), nullable=False),
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id'),
+    sa.UniqueConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('tokencutoffs')
+    with op.batch_alter_table('revokedtokens', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_revokedtokens_expires_at'))
+
+    op.drop_table('revokedtokens')
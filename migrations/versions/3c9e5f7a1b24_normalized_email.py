@@ -0,0 +1,44 @@
+"""Add users.email_normalized for case-insensitive email lookups
+
+Revision ID: 3c9e5f7a1b24
+Revises: 1a6f4d8e2b57
+Create Date: 2026-10-17 21:05:12.318604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e5f7a1b24'
+down_revision = '1a6f4d8e2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('email_normalized', sa.String(length=120), nullable=True))
+
+    # Same normalisation as auth.utils.validation.normalize_email
+    op.execute("UPDATE users SET email_normalized = LOWER(TRIM(email))")
+
+    duplicates = op.get_bind().execute(sa.text(
+        "SELECT email_normalized FROM users "
+        "GROUP BY email_normalized HAVING COUNT(*) > 1")).scalars().all()
+    if duplicates:
+        raise RuntimeError(
+            "Emails differing only in case belong to several accounts; merge or "
+            f"rename them before upgrading: {', '.join(duplicates[:20])}")
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('email_normalized',
+               existing_type=sa.String(length=120),
+               nullable=False)
+        batch_op.create_index(batch_op.f('ix_users_email_normalized'), ['email_normalized'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_users_email_normalized'))
+        batch_op.drop_column('email_normalized')
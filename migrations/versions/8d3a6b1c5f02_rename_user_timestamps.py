@@ -0,0 +1,40 @@
+"""Rename users.createdAt/updatedAt to the created_at/updated_at the models map
+
+Revision ID: 8d3a6b1c5f02
+Revises: 3c9e5f7a1b24
+Create Date: 2026-10-17 22:40:08.512930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3a6b1c5f02'
+down_revision = '3c9e5f7a1b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('createdAt', new_column_name='created_at',
+               existing_type=sa.TIMESTAMP(),
+               existing_server_default=sa.text('(CURRENT_TIMESTAMP)'),
+               existing_nullable=False)
+        batch_op.alter_column('updatedAt', new_column_name='updated_at',
+               existing_type=sa.TIMESTAMP(),
+               existing_server_default=sa.text('(CURRENT_TIMESTAMP)'),
+               existing_nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('updated_at', new_column_name='updatedAt',
+               existing_type=sa.TIMESTAMP(),
+               existing_server_default=sa.text('(CURRENT_TIMESTAMP)'),
+               existing_nullable=True)
+        batch_op.alter_column('created_at', new_column_name='createdAt',
+               existing_type=sa.TIMESTAMP(),
+               existing_server_default=sa.text('(CURRENT_TIMESTAMP)'),
+               existing_nullable=False)
@@ -0,0 +1,32 @@
+"""Widen users.password_hash for self-describing password hashes
+
+Revision ID: 9b1f3c2d4e5a
+Revises: 5edbc376c7fc
+Create Date: 2026-10-17 09:12:41.502113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1f3c2d4e5a'
+down_revision = '5edbc376c7fc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password_hash',
+               existing_type=sa.String(length=60),
+               type_=sa.String(length=255),
+               existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password_hash',
+               existing_type=sa.String(length=255),
+               type_=sa.String(length=60),
+               existing_nullable=False)
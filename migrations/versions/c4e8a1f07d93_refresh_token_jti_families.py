@@ -0,0 +1,47 @@
+"""Key refresh tokens on jti with token families
+
+Revision ID: c4e8a1f07d93
+Revises: 9b1f3c2d4e5a
+Create Date: 2026-10-17 10:03:55.218664
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1f07d93'
+down_revision = '9b1f3c2d4e5a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The table used to be created by db.create_all() and stored whole
+    # JWTs. Refresh tokens are short lived, so drop the old rows rather
+    # than converting them; affected users simply log in again.
+    if sa.inspect(op.get_bind()).has_table('refreshtokens'):
+        op.drop_table('refreshtokens')
+    op.create_table('refreshtokens',
+    sa.Column('jti', sa.String(length=32), nullable=False),
+    sa.Column('family_id', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.String(length=255), nullable=False),
+    sa.Column('used', sa.Boolean(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id'),
+    sa.UniqueConstraint('jti')
+    )
+    with op.batch_alter_table('refreshtokens', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_refreshtokens_family_id'), ['family_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('refreshtokens', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_refreshtokens_family_id'))
+
+    op.drop_table('refreshtokens')
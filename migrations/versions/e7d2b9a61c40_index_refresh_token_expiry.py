@@ -0,0 +1,25 @@
+"""Index refreshtokens.expires_at for the expired token sweeper
+
+Revision ID: e7d2b9a61c40
+Revises: c4e8a1f07d93
+Create Date: 2026-10-17 11:27:08.640391
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7d2b9a61c40'
+down_revision = 'c4e8a1f07d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('refreshtokens', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_refreshtokens_expires_at'), ['expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('refreshtokens', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_refreshtokens_expires_at'))